@@ -16,26 +16,43 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+# to record the time and memory of each stage (each K of the elbow sweep, the final fit, shape file reads, maps), 
+# see census_trace.py
+#import census_trace
+#census_trace.enable()
+
 #%%
 """
 Load the filtered census data set (for Dublin)
 Omitted data directory here, fill in your own directory for the data set
 And explore the data
+
+The 69 summary variables are loaded into one float32 array with a mask of the valid values (see census_store.py);
+ratios with a zero denominator are reported rather than silently kept (inf) or dropped (NaN).
+The small areas with all variables valid are selected by a mask: pc_data is a view of the array
+when there are no invalid values, and census holds the other columns (SAID, COUNTYNAME, SMALL_AREA).
 """
 
-census = pd.read_csv('NewCensusData_final_Dublin.csv')
-census = census.drop(census.columns[0], axis=1)
+from census_store import IndicatorStore
+
+store = IndicatorStore.read_csv('NewCensusData_final_Dublin.csv')
+#store = IndicatorStore.load("NewCensusData_final_Dublin_store")
+store.shape
+store.names
+store.report()
+
+complete = store.complete()
+census = store.records[complete].copy()
+pc_data = store.frame(complete)
 census.head()
 census.shape
-census.columns
-census = census.dropna(axis=0, how='any')
 
-census["Age0_4"].describe()
-census["Age5_14"].describe()
-census["Age25_44"].describe()
-census["Age65over"].describe()
-census["EU_National"].describe()
-census["ROW_National"].describe()
+pc_data["Age0_4"].describe()
+pc_data["Age5_14"].describe()
+pc_data["Age25_44"].describe()
+pc_data["Age65over"].describe()
+pc_data["EU_National"].describe()
+pc_data["ROW_National"].describe()
 
 #%%
 """
@@ -50,37 +67,84 @@ Phase 1 of Model 2: custering census data using k-medoids
 
 No need to re-scale the census data since all variables are of percnetage unit.
 Use the elbow method (elbow plot) to decide the optimum value of K (number of clusters). 
+
+The distances between small areas are computed only once, and shared by all K in the elbow sweep
+(fitted in parallel) and by the final model. 
+For large regions, pass path="pc_data_distances.npy" to keep the distance matrix memory-mapped on disk.
+For all of Ireland, the distance matrix is too large: use engine="fasterpam" (or the faster, sampling based "clara") 
+on pc_data instead, e.g. models = elbow_sweep(pc_data, range(1, 21), random_state=10, engine="fasterpam")
 """
 
-from sklearn_extra.cluster import KMedoids
+from census_clustering import distance_matrix, elbow_sweep
 
-pc_data = census.iloc[:, 0:69]
 pc_data.head()
 pc_data.describe()
 
-sse = {}
-for k in range(1, 21):
-    kmedoids = KMedoids(n_clusters=k, random_state=10)
-    kmedoids.fit(pc_data)
-    sse[k] = kmedoids.inertia_
+dist = distance_matrix(pc_data)
+models = elbow_sweep(dist, range(1, 21), random_state=10)
+sse = {k: m.inertia_ for k, m in models.items()}
 
 plt.xlabel('Number of clustering components')
 plt.ylabel('Sum of Distance')
 sns.pointplot(x=list(sse.keys()), y=list(sse.values()))
 plt.show()
 
+"""
+The elbow plot can be complemented by the average silhouette width and the gap statistic of each K,
+computed from the same distance matrix (the gap statistic clusters 10 uniform reference data sets in parallel)
+"""
+
+from census_clustering import selection_metrics
+
+metrics = selection_metrics(models, dist, pc_data, n_refs=10, random_state=10)
+metrics
+
+fig, axes = plt.subplots(1, 2, figsize=(12, 4))
+sns.pointplot(x=metrics.index, y=metrics["silhouette"], ax=axes[0]).set(xlabel='Number of clustering components', ylabel='Average silhouette width')
+sns.pointplot(x=metrics.index, y=metrics["gap"], ax=axes[1]).set(xlabel='Number of clustering components', ylabel='Gap statistic')
+plt.show()
+
 """
 K=8 is chosen based on the elbow plot. 
 Note that detailed analysis reasoning is included in the paper.
 """
 
-kmedoids = KMedoids(n_clusters=8, random_state=10)
-kmedoids.fit(pc_data)
+kmedoids = models[8]
 cluster_labels = kmedoids.labels_
 census["cluster1"] = cluster_labels+1
 census["cluster1"].value_counts()
 census.head()
 
+"""
+Keep the medoids of the 8 clusters (with the variable order and some metadata) in a file, 
+so that new or revised small area data can be given a cluster without refitting: 
+each row is assigned to its nearest medoid.
+"""
+
+from census_clustering import ClusterModel
+
+cluster_model = ClusterModel.from_fit(kmedoids, pc_data, region="Dublin", random_state=10)
+#cluster_model.save("ClusterModel_Dublin.npz")
+#cluster_model = ClusterModel.load("ClusterModel_Dublin.npz")
+assigned = cluster_model.assign(pc_data)
+(assigned["cluster1"] == census["cluster1"]).mean()
+
+# save the census data with the clusters, e.g. for the lookup service (lookup_service.py)
+#census.to_csv("NewCensusData_final_Dublin_clusters.csv")
+
+"""
+Check how stable the 8 clusters are: refit from 20 random initialisations and on 20 random 80% subsamples.
+The fit with the smallest sum of distance is kept (it can replace the single random_state=10 fit above), 
+and each cluster gets a stability score between 0 and 1 (above 0.75 is usually considered stable). 
+"""
+
+from census_clustering import multi_start
+
+stability = multi_start(dist, 8, n_starts=20, n_subsamples=20, random_state=10)
+stability.inertias
+stability.best.inertia_
+stability.cluster_stability
+
 #%%
 """
 Now 8 census clusters are found
@@ -92,35 +156,49 @@ The first way to profile them is to compare their census summary information acr
 # set the color pallette for plotting, consistent with those in the paper. 
 my_color = {1:"thistle", 2:"burlywood",3:"palegoldenrod",4:"lightpink",5:"paleturquoise",6:"lightgrey",7:"lightsteelblue",8:"darkseagreen"}
 
-# Demographic information
-sns.boxplot(x="cluster1", y="Age5_14", data=census, palette=my_color).set(xlabel='Cluster',ylabel='Age 5-14 population percentage')
-sns.boxplot(x="cluster1", y="Age25_44", data=census, palette=my_color).set(xlabel='Cluster',ylabel='Age 25-44 population percentage')
-sns.boxplot(x="cluster1", y="Age65over", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Age 65 and over population percentage")
-sns.boxplot(x="cluster1", y="Born_outside_Ireland", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Born outside Ireland population percentage")
-
-# Household decomposition
-sns.boxplot(x="cluster1", y="HouseShare", data=census, palette=my_color).set(xlabel='Cluster',ylabel='House share percentage') 
-sns.boxplot(x="cluster1", y="NonDependentKids", data=census, palette=my_color).set(xlabel="Cluster",ylabel='Family with non-dependent children percentage') #
-sns.boxplot(x="cluster1", y="Dink", data=census, palette=my_color).set(xlabel="Cluster", ylabel='Couple with no children percentage')
-sns.boxplot(x="cluster1", y="Married", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Married couple percentage")
-
-# Housing
-sns.boxplot(x="cluster1", y="Flats", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Flat dwelling percentage")
-sns.boxplot(x="cluster1", y="RentPublic", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Public rent percentage")
-sns.boxplot(x="cluster1", y="RentPrivate", data=census, palette=my_color).set(xlabel="Cluster",ylabel="Private rent percentage")
-sns.boxplot(x="cluster1", y="Owned", data=census, palette=my_color).set(xlabel="Cluster",ylabel="Housing owned outright percentage")
-
-# Socio-economic information
-sns.boxplot(x="cluster1", y="HE", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Third level and above educated percentage")
-sns.boxplot(x="cluster1", y="Employed", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Employment percentage")
-sns.boxplot(x="cluster1", y="TwoCars", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Ownership of 2 or moe cars percentage")
-sns.boxplot(x="cluster1", y="SC_professional", data=census, palette=my_color).set(xlabel="Cluster", ylabel="Professional social class percentage")
-
-# Employment
-sns.boxplot(x="cluster1", y="Unemployed", data=census, palette=my_color).set(xlabel="Cluster",ylabel="Unemployment percentage")
+"""
+The summary statistics of all 69 variables in each cluster are computed together in one table
+(quartiles, whiskers, means and standardized difference from the overall mean, see census_profiles.py), 
+which can be saved, and the boxplots are drawn from that table. 
+"""
 
-# Misc
-sns.boxplot(x="cluster1", y="Internet", data=census, palette=my_color).set(xlabel="Cluster",ylabel="Broadband percentage")
+from census_profiles import cluster_profiles, plot_profiles
+
+profiles = cluster_profiles(pc_data, census["cluster1"])
+profiles.head()
+#profiles.to_csv("ClusterProfiles_Dublin.csv")
+
+# profiles.loc["HE"] gives e.g. the "HE" statistics of every cluster
+profiles["std_diff"].unstack("cluster")
+
+boxplot_labels = {
+    # Demographic information
+    "Age5_14": 'Age 5-14 population percentage',
+    "Age25_44": 'Age 25-44 population percentage',
+    "Age65over": "Age 65 and over population percentage",
+    "Born_outside_Ireland": "Born outside Ireland population percentage",
+    # Household decomposition
+    "HouseShare": 'House share percentage',
+    "NonDependentKids": 'Family with non-dependent children percentage',
+    "Dink": 'Couple with no children percentage',
+    "Married": "Married couple percentage",
+    # Housing
+    "Flats": "Flat dwelling percentage",
+    "RentPublic": "Public rent percentage",
+    "RentPrivate": "Private rent percentage",
+    "Owned": "Housing owned outright percentage",
+    # Socio-economic information
+    "HE": "Third level and above educated percentage",
+    "Employed": "Employment percentage",
+    "TwoCars": "Ownership of 2 or moe cars percentage",
+    "SC_professional": "Professional social class percentage",
+    # Employment
+    "Unemployed": "Unemployment percentage",
+    # Misc
+    "Internet": "Broadband percentage",
+}
+
+plot_profiles(profiles, variables=list(boxplot_labels), ylabels=boxplot_labels, palette=my_color)
 
 
 #%%
@@ -132,18 +210,17 @@ Then load the shape files
 Omitted data directory here, fill in your own directory
 """
 
-import shapefile as shp
+from census_geometry import read_geometry
 
-sf = shp.Reader("Census2016_Small_Areas_generalised20m")
+geometry = read_geometry("Census2016_Small_Areas_generalised20m")
 
 # explore the data 
-len(sf.shapes())
-sf.shape()
-sf.shapes()
-dir(sf.shapes()[1])
-sf.shapeRecord(1)
-sf.record(1)[0:8]
-sf.records()
+len(geometry)
+geometry.bbox[1]
+geometry.parts(1)
+geometry.coords(1)
+geometry.records.iloc[1, 0:8]
+geometry.records.head()
 
 """
 The shapefiles store all information about each small area, 
@@ -151,17 +228,13 @@ including descriptive information and boundary geometry information
 
 We need to extract such information properly before using it
 by reading a shapefile into a pandas dataframe with a coords column holding the boundary geometry information.
-"""
 
-def read_shapefile(sf):
-    fields = [x[0] for x in sf.fields][1:]
-    records = sf.records()
-    shps = [s.points for s in sf.shapes()]
-    df = pd.DataFrame(columns=fields, data=records)
-    df = df.assign(coords=shps)
-    return df
+The boundaries of all small areas are stored in flat arrays (see census_geometry.py), 
+cached in the ".census_cache" folder so later runs load them almost instantly, 
+and the coords column holds (n, 2) views of those arrays rather than lists of (x, y) tuples.
+"""
 
-Ireland = read_shapefile(sf)
+Ireland = geometry.to_frame()
 Ireland.shape
 Ireland.head()
 Ireland.iloc[1,]
@@ -175,18 +248,34 @@ Dublin.columns
 Dublin["SMALL_AREA"]
 Dublin["GEOGID"]
 
+"""
+If only one region is needed, the shapefile can be read for that region only: 
+only the COUNTYNAME column of the attribute table is scanned, 
+and only the boundaries of the matching small areas are decoded. 
+A bounding box filter is also possible, e.g. bbox=(-6.34, 53.26, -6.11, 53.41) 
+"""
+
+from census_geometry import read_region
+
+dublin_geometry = read_region("Census2016_Small_Areas_generalised20m", 
+                              where={"COUNTYNAME": ['Fingal','Dublin City','South Dublin','Dún Laoghaire-Rathdown']})
+Dublin = dublin_geometry.to_frame()
+Dublin.shape
+
 """
 First we can plot all the small area boundary data
+
+All boundaries are drawn together from the geometry arrays (see census_maps.py).
+Maps are drawn from the coarsest simplified level of detail that is still exact to the pixel 
+at the requested extent and figure size (see census_simplify.py), so the full Dublin map draws 
+fewer vertices than the zoomed city view; pass lod=False to plot_boundaries or plot_cluster_map to draw every vertex.
+The index of Dublin (and of the data frames derived from it below) is the position of each small area in dublin_geometry.
 """
+
+from census_maps import plot_boundaries, plot_cluster_map
+
 def plot_map(dat, x_lim = None, y_lim = None, figsize = (9,11)):
-    plt.figure(figsize = figsize)
-    for shape in dat["coords"]:
-        x = [ i[0] for i in shape ]
-        y = [ i[1] for i in shape ]
-        plt.plot(x, y, 'k:', alpha=.9)        
-    if (x_lim != None) & (y_lim != None):     
-        plt.xlim(x_lim)
-        plt.ylim(y_lim)
+    plot_boundaries(dublin_geometry, index=dat.index, x_lim=x_lim, y_lim=y_lim, figsize=figsize)
 
 plot_map(Dublin, figsize=(9,11))
 plot_map(Dublin, figsize=(9,11), x_lim=(-6.34, -6.11), y_lim=(53.26,53.41))
@@ -199,7 +288,14 @@ Then we can fill in colours for each small area depending on its cluster members
 census.SAID
 census.SMALL_AREA
 census_sub = census[["SAID", "cluster1"]]
-plotdat = pd.merge(left=Dublin, right=census_sub, how='left', left_on="SMALL_AREA", right_on="SAID")
+
+# join through the integer-coded small area keys (see census_keys.py) rather than merging string columns
+from census_keys import SAKeys, left_join
+
+keys = SAKeys(census["SAID"], Dublin["SMALL_AREA"])
+keys.add_table("census", census["SAID"])
+keys.add_table("geometry", Dublin["SMALL_AREA"])
+plotdat = left_join(Dublin, census_sub, keys.rows("census", Dublin["SMALL_AREA"]))
 plotdat.shape
 
 plotdat["COUNTYNAME"].value_counts()
@@ -215,36 +311,10 @@ def plot_map_fill_cluster_colour(dat, x_lim = None, y_lim = None,
                          figsize = (12,15), 
                          legend = True,
                          color = my_color):
-    
-    plt.figure(figsize = figsize)
-    fig, ax = plt.subplots(figsize = figsize)
-    for shape in dat["coords"]:
-        x = [ i[0] for i in shape ]
-        y = [ i[1] for i in shape ]
-        plt.plot(x, y, 'k--',alpha=0.07)
-    
-    for c in range(1,9):
-        #print(c)
-        tempdat = dat.loc[ dat["cluster1"] == c , ]    
-        for id in range(len(tempdat)):
-            shape_ex = tempdat["coords"].iloc[id]
-            x_lon = np.zeros((len(shape_ex),1))
-            y_lat = np.zeros((len(shape_ex),1))
-            for ip in range(len(shape_ex)):
-                x_lon[ip] = shape_ex[ip][0]
-                y_lat[ip] = shape_ex[ip][1]
-            ax.fill(x_lon,y_lat, color[(c-1)])
-    
-    if (legend == True): 
-        f = lambda m,c: ax.plot([],[],marker=m, color=c, ls="none")[0]
-        handles = [f("s", color[i]) for i in range(8)]
-        labels = ['Cluster 1','Cluster 2','Cluster 3','Cluster 4','Cluster 5','Cluster 6','Cluster 7','Cluster 8']
-        ax.legend(handles,labels, loc='lower right',frameon=False,
-                  markerscale=4, fontsize='xx-large', bbox_to_anchor=(1.3,0))
-               
-    if (x_lim != None) & (y_lim != None):     
-        plt.xlim(x_lim)
-        plt.ylim(y_lim)
+    # one PolyCollection for all small areas, coloured by cluster1; 
+    # with x_lim and y_lim only the small areas in view are drawn
+    plot_cluster_map(dublin_geometry, dat["cluster1"], index=dat.index, x_lim=x_lim, y_lim=y_lim,
+                     figsize=figsize, legend=legend, color=color)
 
 
 plot_map_fill_cluster_colour(plotdat, figsize=(9, 11), legend=True)
@@ -253,3 +323,49 @@ plot_map_fill_cluster_colour(SouthDublin, figsize=(9,9),legend=False)
 plot_map_fill_cluster_colour(DublinCity, figsize=(9,9),legend=False)
 plot_map_fill_cluster_colour(Fingal, figsize=(9,9),legend=False)
 plot_map_fill_cluster_colour(DunLR, figsize=(9,9),legend=False)
+
+
+#%%
+"""
+Assign geocoded locations (e.g. policyholder addresses, as longitude and latitude) to their small area and cluster
+
+The spatial index only tests each point against the few small areas around it, 
+points are processed in chunks, in parallel across cores with n_jobs=-1.
+"""
+
+from census_spatial import SpatialIndex
+
+index = SpatialIndex(dublin_geometry)
+
+lon = np.array([-6.2603, -6.2297, -6.1355])
+lat = np.array([53.3498, 53.3331, 53.2946])
+located = pd.DataFrame({"lon": lon, "lat": lat, "SMALL_AREA": index.small_areas(lon, lat, n_jobs=1)})
+located = left_join(located, census_sub, keys.rows("census", located["SMALL_AREA"].fillna("")))
+located
+
+
+#%%
+"""
+Neighbouring small areas (e.g. for spatial smoothing or spatially constrained clustering)
+
+Queen neighbours share at least one boundary point, Rook neighbours share at least one boundary edge. 
+The result is a sparse adjacency matrix, rows and columns in the order of the small areas in the geometry.
+For a geometry loaded with read_geometry, it is cached next to the geometry arrays. 
+"""
+
+from census_spatial import contiguity
+
+queen = contiguity(dublin_geometry, kind="queen")
+rook = contiguity(dublin_geometry, kind="rook")
+queen.shape
+queen.sum(axis=1)
+
+
+#%%
+"""
+Time, CPU time and memory of each stage, if census_trace.enable() was run above
+The trace file can be opened in chrome://tracing or https://ui.perfetto.dev
+"""
+
+#census_trace.summary()
+#census_trace.write_chrome_trace("clustering_trace.json")
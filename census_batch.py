@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Cluster and map several regions (sets of counties) in one command.
+
+For each region the pipeline of the two scripts is run: extraction of the summary variables (once, for all regions),
+filtering of the region, elbow sweep, final k-medoids, cluster profiles and maps, with the stages cached
+as in census_pipeline.py. The regions are processed in a pool of worker processes; the census table and the
+boundaries of all small areas are loaded once, and the boundaries are memory-mapped by every worker.
+
+    python census_batch.py SAPS2016_SA2017.csv Small_Areas_Boundaries_2015.csv Census2016_Small_Areas_generalised20m \\
+        --region "Dublin=Fingal,Dublin City,South Dublin,Dún Laoghaire-Rathdown" --region Kerry --out results
+    python census_batch.py SAPS2016_SA2017.csv Small_Areas_Boundaries_2015.csv Census2016_Small_Areas_generalised20m --all-counties
+
+Each region gets a folder in --out with the census table with clusters, the cluster profiles, the medoids
+(census_clustering.ClusterModel), the elbow plot, boxplots and maps; summary.json lists the results of all regions.
+With --trace trace.json, the stages of all workers are recorded in one Chrome trace (see census_trace.py).
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+import census_pipeline as pipeline
+import census_trace
+from census_clustering import ClusterModel
+from census_geometry import Geometry, read_geometry
+from census_indicators import INDICATOR_NAMES
+from census_keys import SAKeys
+from census_maps import my_color, plot_cluster_map
+from census_profiles import cluster_profiles, plot_profiles
+from census_trace import stage
+from stage_cache import StageCache
+
+DUBLIN = ['Fingal', 'Dublin City', 'South Dublin', 'Dún Laoghaire-Rathdown']
+
+# variables drawn as boxplots, as in the clustering script
+BOXPLOT_VARIABLES = ["Age5_14", "Age25_44", "Age65over", "Born_outside_Ireland", "HouseShare", "NonDependentKids",
+                     "Dink", "Married", "Flats", "RentPublic", "RentPrivate", "Owned", "HE", "Employed", "TwoCars",
+                     "SC_professional", "Unemployed", "Internet"]
+
+# census table and geometry of all small areas, set once in each worker by _init_worker
+_shared = {}
+
+def _init_worker(ireland, geometry_directory, cache_dir):
+    _shared["ireland"] = ireland
+    _shared["geometry"] = Geometry.load(geometry_directory, mmap=True)
+    _shared["cache"] = StageCache(cache_dir)
+
+def _slug(name):
+    return re.sub(r"[^\w\-]+", "_", name).strip("_")
+
+def _save(fig, path):
+    with stage("savefig", file=os.path.basename(path)):
+        fig.savefig(path, bbox_inches="tight")
+        plt.close(fig)
+
+def run_region(name, counties, out_dir, ks=range(1, 21), k=8, random_state=10, engine="precomputed"):
+    """
+    Run the pipeline for one region in a worker; returns a JSON-ready summary
+    """
+    with stage("region " + name, counties=len(counties)):
+        return _run_region(name, counties, out_dir, ks, k, random_state, engine)
+
+def _run_region(name, counties, out_dir, ks, k, random_state, engine):
+    start = time.perf_counter()
+    cache, geometry = _shared["cache"], _shared["geometry"]
+    census = pipeline.region(cache, _shared["ireland"], counties)
+    if len(census.value) < max(k, max(ks)):
+        return {"region": name, "counties": counties, "n_areas": len(census.value),
+                "error": "fewer small areas than clusters"}
+    data = pipeline.distances(cache, census) if engine == "precomputed" else census
+    sweep = pipeline.sweep(cache, data, ks, random_state, engine, n_jobs=1)
+    final = pipeline.final(cache, data, sweep, k, random_state, engine)
+
+    folder = os.path.join(out_dir, _slug(name))
+    os.makedirs(folder, exist_ok=True)
+    census = census.value.copy()
+    census["cluster1"] = final.value["cluster1"]
+    census.to_csv(os.path.join(folder, "census_clusters.csv"))
+    pc_data = census[INDICATOR_NAMES]
+    medoids = pc_data.iloc[np.asarray(final.value["medoids"])]
+    ClusterModel(medoids, INDICATOR_NAMES, {"region": name, "counties": counties, "random_state": random_state,
+                                            "n_clusters": k, "n_train": len(census),
+                                            "inertia": float(final.value["inertia"][0])}
+                 ).save(os.path.join(folder, "ClusterModel.npz"))
+
+    fig, ax = plt.subplots()
+    ax.plot(sweep.value["ks"], sweep.value["inertia"], marker="o")
+    ax.set(xlabel='Number of clustering components', ylabel='Sum of Distance')
+    _save(fig, os.path.join(folder, "elbow.png"))
+
+    color = my_color if k <= len(my_color) else [plt.cm.tab20(i % 20) for i in range(k)]
+    profiles = cluster_profiles(pc_data, census["cluster1"])
+    profiles.to_csv(os.path.join(folder, "profiles.csv"))
+    variables = [v for v in BOXPLOT_VARIABLES if v in INDICATOR_NAMES]
+    for variable, ax in zip(variables, plot_profiles(profiles, variables, palette=dict(enumerate(color, 1)))):
+        _save(ax.figure, os.path.join(folder, "boxplot_%s.png" % variable))
+
+    # positions of the region's small areas in the shared geometry, and their clusters
+    records = geometry.records
+    positions = np.flatnonzero(records["COUNTYNAME"].isin(counties).to_numpy())
+    keys = SAKeys(census["SAID"])
+    keys.add_table("census", census["SAID"])
+    rows = keys.rows("census", records["SMALL_AREA"].iloc[positions])
+    clusters = np.where(rows >= 0, census["cluster1"].to_numpy()[np.maximum(rows, 0)], np.nan)
+    maps = {name: positions} if len(counties) == 1 else dict(
+        [(name, positions)] + [(county, positions[records["COUNTYNAME"].iloc[positions].to_numpy() == county])
+                               for county in counties])
+    for map_name, index in maps.items():
+        if len(index):
+            fig, _ = plot_cluster_map(geometry, clusters[np.isin(positions, index)], index=index,
+                                      figsize=(9, 11), legend=map_name == name, color=color)
+            _save(fig, os.path.join(folder, "map_%s.png" % _slug(map_name)))
+
+    return {"region": name, "counties": counties, "n_areas": len(census), "n_mapped": int(np.sum(rows >= 0)),
+            "k": k, "inertia": float(final.value["inertia"][0]),
+            "cluster_sizes": {str(c): int(n) for c, n in census["cluster1"].value_counts().sort_index().items()},
+            "folder": folder, "seconds": time.perf_counter() - start}
+
+def parse_regions(specs, all_counties, counties):
+    """
+    {region name: counties} from "Name=County 1,County 2" or "County" specs, or one region per county
+    """
+    if all_counties:
+        return {county: [county] for county in counties}
+    if not specs:
+        return {"Dublin": DUBLIN}
+    regions = {}
+    for spec in specs:
+        name, _, members = spec.partition("=")
+        regions[name.strip()] = [c.strip() for c in members.split(",")] if members else [name.strip()]
+    unknown = sorted(set(c for members in regions.values() for c in members) - set(counties))
+    if unknown:
+        raise ValueError("unknown counties: %s" % ", ".join(unknown))
+    return regions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cluster and map the small areas of several regions")
+    parser.add_argument("saps", help="SAPS csv, e.g. SAPS2016_SA2017.csv")
+    parser.add_argument("refkey", help="small area boundary key table, e.g. Small_Areas_Boundaries_2015.csv")
+    parser.add_argument("shapefile", help="small area shape file (without extension)")
+    parser.add_argument("--region", action="append", help='"Name=County 1,County 2" or "County", repeatable; Dublin by default')
+    parser.add_argument("--all-counties", action="store_true", help="one region per county")
+    parser.add_argument("--ks", type=int, nargs=2, default=(1, 20), metavar=("FIRST", "LAST"), help="range of K of the elbow sweep")
+    parser.add_argument("--k", type=int, default=8, help="number of clusters of the final model")
+    parser.add_argument("--random-state", type=int, default=10)
+    parser.add_argument("--engine", default="precomputed", choices=["precomputed", "fasterpam", "clara"])
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (all cores by default)")
+    parser.add_argument("--out", default="results")
+    parser.add_argument("--cache-dir", default=".census_cache/stages")
+    parser.add_argument("--trace", help="write a Chrome trace of the stages of all regions to this file")
+    args = parser.parse_args(argv)
+    if args.trace:
+        census_trace.enable()
+
+    cache = StageCache(args.cache_dir)
+    ireland = pipeline.indicators(cache, args.saps, args.refkey)
+    geometry = read_geometry(args.shapefile)
+    if geometry.directory is None:
+        raise ValueError("the geometry cache could not be written next to %s" % args.shapefile)
+    counties = sorted(geometry.records["COUNTYNAME"].dropna().unique())
+    regions = parse_regions(args.region, args.all_counties, counties)
+    ks = range(args.ks[0], args.ks[1] + 1)
+    os.makedirs(args.out, exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                             initargs=(ireland, geometry.directory, args.cache_dir)) as pool:
+        run = (run_region, ) if not census_trace.enabled() else (census_trace.collect, run_region)
+        futures = {pool.submit(*run, name, members, args.out, ks, args.k, args.random_state, args.engine): name
+                   for name, members in regions.items()}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                if census_trace.enabled():
+                    result, events = result
+                    census_trace.add_events(events)
+            except Exception as e:
+                result = {"region": futures[future], "error": repr(e)}
+            print("%-25s %s" % (result["region"], result.get("error") or "%d small areas, %.1fs" % (result["n_areas"], result["seconds"])))
+            results.append(result)
+
+    results.sort(key=lambda r: r["region"])
+    with open(os.path.join(args.out, "summary.json"), "w") as f:
+        json.dump(results, f, indent=1)
+    if args.trace:
+        census_trace.write_chrome_trace(args.trace)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the pipeline on synthetic data (census_synthetic.py).
+
+For each number of small areas, the synthetic files are generated (or reused) and each stage is timed
+and memory-profiled: wall and CPU time, the peak of the memory allocated during the stage (tracemalloc,
+which also counts numpy arrays) and the peak resident set size of the process so far.
+
+    csv_load         load_saps (without its cache)
+    indicators       compute_indicators
+    said_join        boundary key table read and joined through SAKeys
+    distance_matrix  pairwise distances of the clustered rows (engine="precomputed" only)
+    elbow_sweep      k-medoids for each K
+    final_kmedoids   k-medoids with the final K
+    shapefile_load   read_geometry (without its cache)
+    map_render       cluster map of all small areas, rendered to png in memory
+
+With --trace, the finer stages inside them (indicator themes, each k, ...) are also written as a Chrome trace
+(see census_trace.py).
+
+The distance matrix grows with the square of the number of rows, so only the first --cluster-rows rows are
+clustered with engine="precomputed" (use --engine fasterpam or clara to cluster more); all small areas
+are then assigned to the nearest medoid for the map. The results are written as JSON, e.g.
+
+    python census_benchmark.py --sizes 1000 10000 100000 --out benchmark.json
+    python census_benchmark.py --sizes 1000 10000 100000 --out new.json --compare benchmark.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import census_trace
+from census_clustering import ClusterModel, distance_matrix, elbow_sweep, fit_kmedoids
+from census_geometry import read_geometry
+from census_indicators import INDICATOR_NAMES, SAPS_KEY, compute_indicators, load_saps
+from census_keys import SAKeys, left_join, normalize_said
+from census_maps import plot_cluster_map
+from census_synthetic import make_dataset
+
+def _measure(stages, name, fn, memory=True):
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    value = fn()
+    stages[name] = {"seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu}
+    if memory:
+        stages[name]["peak_alloc_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    stages[name]["max_rss_mb"] = census_trace.max_rss_mb()
+    return value
+
+def _cluster(stages, sample, ks, k, engine, n_jobs, memory):
+    # the clustering stages; the distance matrix is freed when this returns, before the shape file is loaded
+    data = sample
+    if engine == "precomputed":
+        data = _measure(stages, "distance_matrix", lambda: distance_matrix(sample), memory)
+    _measure(stages, "elbow_sweep", lambda: elbow_sweep(data, ks, 10, engine, n_jobs), memory)
+    return _measure(stages, "final_kmedoids", lambda: fit_kmedoids(data, k, 10, engine), memory)
+
+def run(n_areas, directory, cluster_rows=5000, ks=range(1, 11), k=8, engine="precomputed", n_jobs=1,
+        memory=True, seed=0):
+    """
+    Timings of every stage for n_areas synthetic small areas, as a JSON-ready dict
+    """
+    data_dir = os.path.join(directory, "%d_%d" % (n_areas, seed))
+    start = time.perf_counter()
+    if os.path.exists(os.path.join(data_dir, "Census2016_Small_Areas_generalised20m.dbf")):
+        paths = {"saps": os.path.join(data_dir, "SAPS2016_SA2017.csv"),
+                 "refkey": os.path.join(data_dir, "Small_Areas_Boundaries_2015.csv"),
+                 "shapefile": os.path.join(data_dir, "Census2016_Small_Areas_generalised20m")}
+    else:
+        paths = make_dataset(data_dir, n_areas, seed)
+    generate = time.perf_counter() - start
+
+    stages = {}
+    df = _measure(stages, "csv_load", lambda: load_saps(paths["saps"], cache=False), memory)
+
+    def indicators():
+        census = compute_indicators(df)
+        census["SAID"] = normalize_said(df[SAPS_KEY])
+        return census
+    census = _measure(stages, "indicators", indicators, memory)
+
+    def said_join():
+        refkey = pd.read_csv(paths["refkey"], dtype=str)[["COUNTYNAME", "SMALL_AREA"]]
+        keys = SAKeys(census["SAID"], refkey["SMALL_AREA"])
+        keys.add_table("refkey", refkey["SMALL_AREA"])
+        return left_join(census, refkey, keys.rows("refkey", census["SAID"]))
+    census = _measure(stages, "said_join", said_join, memory).dropna(axis=0, how='any')
+
+    pc_data = census[INDICATOR_NAMES]
+    sample = pc_data.iloc[:cluster_rows] if engine == "precomputed" else pc_data
+    model = _cluster(stages, sample, ks, k, engine, n_jobs, memory)
+
+    geometry = _measure(stages, "shapefile_load", lambda: read_geometry(paths["shapefile"], cache=False), memory)
+    clusters = ClusterModel.from_fit(model, sample).assign(pc_data)["cluster1"].to_numpy(dtype=float, na_value=np.nan)
+    keys = SAKeys(census["SAID"])
+    keys.add_table("census", census["SAID"])
+    rows = keys.rows("census", geometry.records["SMALL_AREA"])
+    shape_clusters = np.where(rows >= 0, clusters[np.maximum(rows, 0)], np.nan)
+
+    def map_render():
+        fig, _ = plot_cluster_map(geometry, shape_clusters, figsize=(9, 11), legend=False)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=100)
+        plt.close(fig)
+        return buffer.tell()
+    _measure(stages, "map_render", map_render, memory)
+
+    return {"n_areas": n_areas, "n_vertices": len(geometry.vertices), "cluster_rows": len(sample),
+            "engine": engine, "ks": list(ks), "k": k, "n_jobs": n_jobs, "generate_seconds": generate,
+            "stages": stages}
+
+def environment():
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "platform": platform.platform(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "cpu_count": os.cpu_count()}
+
+CONFIGURATION = ["n_areas", "engine", "ks", "k", "cluster_rows", "n_jobs"]
+
+def _configuration(r):
+    return tuple(tuple(r[c]) if c == "ks" else r[c] for c in CONFIGURATION)
+
+def compare(new, old):
+    """
+    Table of the time of each stage in `new` relative to `old` (both outputs of main), for the runs with the same
+    configuration (size, engine, ks, k, clustered rows and jobs). Runs without a counterpart get one row with
+    no stage, noted "only in new" or "only in old", instead of being compared with a different configuration.
+    """
+    new_runs = {_configuration(r): r for r in new["runs"]}
+    old_runs = {_configuration(r): r for r in old["runs"]}
+    rows = []
+    for config, r in new_runs.items():
+        base = dict(zip(CONFIGURATION, config))
+        if config not in old_runs:
+            rows.append(dict(base, note="only in new"))
+            continue
+        for stage, m in r["stages"].items():
+            before = old_runs[config]["stages"].get(stage)
+            if before:
+                rows.append(dict(base, stage=stage, old_seconds=before["seconds"], new_seconds=m["seconds"],
+                                 ratio=m["seconds"] / before["seconds"]))
+    for config in old_runs:
+        if config not in new_runs:
+            rows.append(dict(zip(CONFIGURATION, config), note="only in old"))
+    return pd.DataFrame(rows, columns=CONFIGURATION + ["stage", "old_seconds", "new_seconds", "ratio", "note"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the census pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="numbers of small areas")
+    parser.add_argument("--data-dir", default="benchmark_data", help="where the synthetic files are written (and reused)")
+    parser.add_argument("--cluster-rows", type=int, default=5000)
+    parser.add_argument("--ks", type=int, nargs=2, default=(1, 10), metavar=("FIRST", "LAST"))
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--engine", default="precomputed", choices=["precomputed", "fasterpam", "clara"])
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true", help="time only, without tracemalloc overhead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", help="an earlier output of this benchmark to compare with")
+    parser.add_argument("--trace", help="also write a Chrome trace of all stages to this file")
+    args = parser.parse_args(argv)
+    if args.trace:
+        census_trace.enable()
+
+    results = {"environment": environment(), "runs": []}
+    for n in args.sizes:
+        r = run(n, args.data_dir, args.cluster_rows, range(args.ks[0], args.ks[1] + 1), args.k, args.engine,
+                args.n_jobs, not args.no_memory, args.seed)
+        results["runs"].append(r)
+        print("%d small areas: %s" % (n, ", ".join("%s %.2fs" % (s, m["seconds"]) for s, m in r["stages"].items())))
+        # written after every size, so a long run can be inspected (or killed) midway
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.trace:
+        census_trace.write_chrome_trace(args.trace)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)).to_string(index=False))
+    return results
+
+if __name__ == "__main__":
+    main()
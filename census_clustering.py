@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for Phase 1 of Model 2 in the paper:
+    Hu et al (2020), "A spatial machine learning model for analyzing customers' lapse behaviour in life insurance", Annals of Actuarial Science.
+
+The pairwise distance matrix of the census summary variables is computed once,
+stored as float32 (optionally memory-mapped to a .npy file),
+and shared by every k of the elbow sweep and by the final k-medoids model.
+For national-scale data, the FasterPAM and Clara engines avoid the distance matrix altogether.
+"""
+
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn_extra.cluster import KMedoids
+
+import census_trace
+from census_trace import stage
+
+def distance_matrix(X, path=None, block_size=2048):
+    """
+    Euclidean distances between the rows of X, as an (n, n) float32 array.
+
+    If `path` is given the matrix is written to that .npy file and returned memory-mapped,
+    so it never has to fit in memory and can be reopened with np.load(path, mmap_mode="r").
+    """
+    with stage("distance matrix", rows=len(X)):
+        return _distance_matrix(X, path, block_size)
+
+def _distance_matrix(X, path, block_size):
+    X = np.asarray(X, dtype=np.float64)
+    n = X.shape[0]
+    if path is None:
+        D = np.empty((n, n), dtype=np.float32)
+    else:
+        D = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n, n))
+    sq = np.einsum("ij,ij->i", X, X)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        d2 = sq[start:stop, None] + sq[None, :] - 2 * X[start:stop] @ X.T
+        np.maximum(d2, 0, out=d2)
+        D[start:stop] = np.sqrt(d2)
+    np.fill_diagonal(D, 0)
+    if path is not None:
+        D.flush()
+    return D
+
+def fit_kmedoids(data, k, random_state=10, engine="precomputed", **kwargs):
+    """
+    Fit k-medoids with k clusters.
+
+    With engine="precomputed", `data` is the distance matrix and sklearn_extra's KMedoids is used.
+    With engine="fasterpam" or "clara", `data` is the census variables (see the scalable engines below).
+    """
+    if engine == "precomputed":
+        model = KMedoids(n_clusters=k, metric="precomputed", random_state=random_state, **kwargs)
+    elif engine in ENGINES:
+        model = ENGINES[engine](n_clusters=k, random_state=random_state, **kwargs)
+    else:
+        raise ValueError("engine=%s is not supported. Supported engines are 'precomputed', %s."
+                         % (engine, ", ".join("'%s'" % e for e in ENGINES)))
+    with stage("kmedoids k=%d" % k, rows=len(data), engine=engine):
+        return model.fit(data)
+
+def elbow_sweep(data, ks=range(1, 21), random_state=10, engine="precomputed", n_jobs=-1, **kwargs):
+    """
+    Fit k-medoids for every k in `ks` on the same data, in parallel.
+
+    Returns a dict {k: fitted model}; the model of the chosen K can be used directly as the final model.
+    Large arrays (e.g. the distance matrix) are memory-mapped to the workers by joblib instead of being copied.
+    When tracing (census_trace.py), the fits of each k are traced in the workers and their events collected.
+    """
+    ks = list(ks)
+    with stage("elbow sweep", rows=len(data), ks=len(ks), engine=engine):
+        if not census_trace.enabled():
+            models = Parallel(n_jobs=n_jobs)(delayed(fit_kmedoids)(data, k, random_state, engine, **kwargs) for k in ks)
+            return dict(zip(ks, models))
+        fits = Parallel(n_jobs=n_jobs)(delayed(census_trace.collect)(fit_kmedoids, data, k, random_state, engine, **kwargs)
+                                       for k in ks)
+        for _, events in fits:
+            census_trace.add_events(events)
+        return dict(zip(ks, [model for model, _ in fits]))
+
+#%%
+"""
+Scalable k-medoids engines for national-scale data
+
+The engines above need the full (n, n) distance matrix, which is several GB for all ~18.6k small areas of Ireland.
+FasterPAM and Clara work on the census variables directly, keeping only O(n*k) distances in memory, 
+and expose the same labels_, medoid_indices_ and inertia_ as sklearn_extra's KMedoids. 
+
+FasterPAM follows Schubert & Rousseeuw (2021): the swap of every candidate point against all k medoids 
+is evaluated in one pass over the data, and a swap is applied as soon as it improves the total distance. 
+Clara (Kaufman & Rousseeuw 1990) runs FasterPAM on random samples and keeps the medoids best for the whole data set. 
+"""
+
+def _distances_to(X, Y, sq_X=None):
+    # Euclidean distances between the rows of X and the rows of Y
+    if sq_X is None:
+        sq_X = np.einsum("ij,ij->i", X, X)
+    d2 = sq_X[:, None] + np.einsum("ij,ij->i", Y, Y)[None, :] - 2 * X @ Y.T
+    return np.sqrt(np.maximum(d2, 0))
+
+def _assign(X, medoids, chunk_size=65536):
+    # nearest medoid and distance to it, chunked so only O(chunk_size*k) distances are held at once
+    labels = np.empty(len(X), dtype=np.intp)
+    dist = np.empty(len(X))
+    for start in range(0, len(X), chunk_size):
+        # float32 data (e.g. from census_store.py) is widened one chunk at a time
+        chunk = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+        d = _distances_to(chunk, medoids)
+        nearest = np.argmin(d, axis=1)
+        distance = d[np.arange(len(d)), nearest]
+        # rows with a NaN or inf value have no nearest medoid (argmin would give the first one): label -1
+        invalid = ~np.isfinite(chunk).all(axis=1)
+        nearest[invalid], distance[invalid] = -1, np.nan
+        labels[start:start + chunk_size] = nearest
+        dist[start:start + chunk_size] = distance
+    return labels, dist
+
+def _kmedoids_plusplus(X, k, rng, sq_X):
+    # k-medoids++ seeding, O(n*k)
+    medoids = [rng.integers(len(X))]
+    dnear = _distances_to(X, X[medoids], sq_X)[:, 0]
+    for _ in range(1, k):
+        p = dnear ** 2
+        c = rng.choice(len(X), p=p / p.sum()) if p.sum() > 0 else rng.integers(len(X))
+        medoids.append(c)
+        dnear = np.minimum(dnear, _distances_to(X, X[[c]], sq_X)[:, 0])
+    return np.array(medoids)
+
+def _nearest_two(DM):
+    # nearest medoid of every point, its distance, and the distance to the second nearest medoid
+    rows = np.arange(len(DM))
+    if DM.shape[1] == 1:
+        return np.zeros(len(DM), dtype=np.intp), DM[:, 0].copy(), np.full(len(DM), np.inf)
+    order = np.argpartition(DM, 1, axis=1)
+    return order[:, 0], DM[rows, order[:, 0]], DM[rows, order[:, 1]]
+
+class FasterPAM:
+    """
+    Swap-based k-medoids (PAM) with O(n*k) memory.
+
+    Parameters
+    ----------
+    n_clusters : number of clusters
+    max_iter : maximum number of passes over the candidate points
+    block_size : number of candidate points whose distances are computed together
+    random_state : seed of the k-medoids++ initialisation
+    init : optional array of initial medoid indices
+    """
+
+    def __init__(self, n_clusters=8, max_iter=100, block_size=256, random_state=None, init=None):
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.block_size = block_size
+        self.random_state = random_state
+        self.init = init
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float64)
+        n, k = len(X), self.n_clusters
+        if k > n:
+            raise ValueError("The number of medoids (%d) must be less than the number of samples %d." % (k, n))
+        sq_X = np.einsum("ij,ij->i", X, X)
+
+        if k == 1:
+            # the single medoid is the point with the smallest total distance to all others
+            totals = np.concatenate([_distances_to(X, X[start:start + self.block_size], sq_X).sum(axis=0)
+                                     for start in range(0, n, self.block_size)])
+            medoids = np.array([np.argmin(totals)])
+            self.n_iter_ = 1
+        else:
+            if self.init is not None:
+                medoids = np.array(self.init)
+            else:
+                medoids = _kmedoids_plusplus(X, k, np.random.default_rng(self.random_state), sq_X)
+            medoids = self._swap(X, sq_X, medoids)
+
+        near, dnear, _ = _nearest_two(_distances_to(X, X[medoids], sq_X))
+        self.medoid_indices_ = medoids
+        self.cluster_centers_ = X[medoids]
+        self.labels_ = near
+        self.inertia_ = dnear.sum()
+        return self
+
+    def _swap(self, X, sq_X, medoids):
+        n, k = len(X), self.n_clusters
+        is_medoid = np.zeros(n, dtype=bool)
+        is_medoid[medoids] = True
+        # distances of every point to every medoid
+        DM = _distances_to(X, X[medoids], sq_X)
+        near, dnear, dsec = _nearest_two(DM)
+        removal_loss = np.bincount(near, dsec - dnear, minlength=k)
+        tol = 1e-12 * max(dnear.sum(), 1)
+
+        # eager swaps: a swap is applied as soon as it reduces the total distance;
+        # stop after a full pass over the data without any swap
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            swapped = False
+            for start in range(0, n, self.block_size):
+                candidates = np.arange(start, min(start + self.block_size, n))
+                block = _distances_to(X, X[candidates], sq_X)
+                for j, c in enumerate(candidates):
+                    if is_medoid[c]:
+                        continue
+                    d_c = block[:, j]
+                    closer = d_c < dnear
+                    acc = np.sum(d_c[closer] - dnear[closer])
+                    delta = removal_loss - np.bincount(near[closer], dsec[closer] - dnear[closer], minlength=k)
+                    second = ~closer & (d_c < dsec)
+                    delta += np.bincount(near[second], d_c[second] - dsec[second], minlength=k)
+                    i = np.argmin(delta)
+                    if delta[i] + acc < -tol:
+                        is_medoid[medoids[i]] = False
+                        is_medoid[c] = True
+                        medoids[i] = c
+                        DM[:, i] = d_c
+                        near, dnear, dsec = _nearest_two(DM)
+                        removal_loss = np.bincount(near, dsec - dnear, minlength=k)
+                        swapped = True
+            if not swapped:
+                break
+        return medoids
+
+class Clara:
+    """
+    CLARA k-medoids: FasterPAM on random samples, keeping the medoids with the smallest total distance on the whole data.
+
+    Parameters
+    ----------
+    n_clusters : number of clusters
+    sample_size : number of points in each sample, defaults to 40 + 2 * n_clusters as in Kaufman & Rousseeuw, 
+                  at least 1000 points (or all points if fewer)
+    n_sampling : number of samples drawn
+    random_state : seed of the samples and of the FasterPAM initialisations
+    """
+
+    def __init__(self, n_clusters=8, sample_size=None, n_sampling=5, random_state=None):
+        self.n_clusters = n_clusters
+        self.sample_size = sample_size
+        self.n_sampling = n_sampling
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float64)
+        n, k = len(X), self.n_clusters
+        if k > n:
+            raise ValueError("The number of medoids (%d) must be less than the number of samples %d." % (k, n))
+        size = self.sample_size or max(40 + 2 * k, 1000)
+        size = min(size, n)
+        rng = np.random.default_rng(self.random_state)
+
+        best = None
+        for _ in range(self.n_sampling):
+            sample = np.sort(rng.choice(n, size=size, replace=False))
+            if best is not None:
+                # keep the current best medoids in the sample, so the result can only improve
+                sample = np.union1d(sample, best[0])
+            pam = FasterPAM(k, random_state=rng.integers(2**31)).fit(X[sample])
+            medoids = sample[pam.medoid_indices_]
+            labels, dist = _assign(X, X[medoids])
+            if best is None or dist.sum() < best[3]:
+                best = (medoids, labels, dist, dist.sum())
+            if size == n:
+                break
+
+        self.medoid_indices_, self.labels_, _, self.inertia_ = best
+        self.cluster_centers_ = X[self.medoid_indices_]
+        return self
+
+ENGINES = {"fasterpam": FasterPAM, "clara": Clara}
+
+
+#%%
+"""
+Stability of the clusters
+
+The clusters in the paper come from a single initialisation (random_state=10). 
+multi_start() refits k-medoids from many random initialisations on the full data, and on many random subsamples, 
+in a process pool. The data (or the distance matrix) is memory-mapped to the workers once by joblib, not copied per fit. 
+
+It keeps the fit with the smallest total distance, and reports 
+- the co-assignment matrix: how often each pair of small areas is in the same cluster, among the fits containing both,
+- the stability of each cluster: its mean Jaccard similarity to the most similar cluster of each subsample fit 
+  (Hennig 2007, values above 0.75 are usually considered stable). 
+"""
+
+Stability = namedtuple("Stability", ["best", "inertias", "coassignment", "cluster_stability"])
+
+def _fit_subset(data, k, seed, sample, engine, kwargs):
+    if engine == "precomputed":
+        kwargs = dict({"init": "k-medoids++"}, **kwargs)
+        if sample is not None:
+            data = data[np.ix_(sample, sample)]
+    elif sample is not None:
+        data = data[sample]
+    return fit_kmedoids(data, k, seed, engine, **kwargs)
+
+def _jaccard_to_reference(reference, labels, k):
+    # best Jaccard similarity of every reference cluster to the clusters in `labels` (same points)
+    counts = np.bincount(reference * k + labels, minlength=k * k).reshape(k, k)
+    union = counts.sum(axis=1)[:, None] + counts.sum(axis=0)[None, :] - counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(counts / union).max(axis=1)
+
+def multi_start(data, k, n_starts=20, n_subsamples=20, sample_fraction=0.8, random_state=10,
+                engine="precomputed", coassignment=True, n_jobs=-1, **kwargs):
+    """
+    Fit k-medoids from `n_starts` random initialisations, and on `n_subsamples` subsamples of the data.
+
+    `data` is the distance matrix for engine="precomputed", otherwise the census variables.
+    Set coassignment=False to skip the (n, n) co-assignment matrix for very large data.
+    Returns a Stability tuple (best model, inertias of the starts, co-assignment matrix, per-cluster stability).
+    """
+    data = np.asarray(data)
+    n = len(data)
+    rng = np.random.default_rng(random_state)
+    seeds = rng.integers(2**31, size=n_starts + n_subsamples)
+    m = int(round(sample_fraction * n))
+    samples = [None] * n_starts + [np.sort(rng.choice(n, size=m, replace=False)) for _ in range(n_subsamples)]
+
+    fits = Parallel(n_jobs=n_jobs)(delayed(_fit_subset)(data, k, seed, sample, engine, kwargs)
+                                   for seed, sample in zip(seeds, samples))
+    inertias = np.array([fit.inertia_ for fit in fits[:n_starts]])
+    best = fits[int(np.argmin(inertias))]
+
+    together = None
+    if coassignment:
+        together = np.zeros((n, n), dtype=np.float32)
+        sampled = np.zeros((n, n), dtype=np.float32)
+    scores = np.zeros((n_subsamples, k))
+    for r, (fit, sample) in enumerate(zip(fits, samples)):
+        idx = np.arange(n) if sample is None else sample
+        if coassignment:
+            onehot = np.eye(k, dtype=np.float32)[fit.labels_]
+            together[np.ix_(idx, idx)] += onehot @ onehot.T
+            sampled[np.ix_(idx, idx)] += 1
+        if sample is not None:
+            scores[r - n_starts] = _jaccard_to_reference(best.labels_[sample], fit.labels_, k)
+    if coassignment:
+        together /= np.maximum(sampled, 1)
+
+    return Stability(best, inertias, together, scores.mean(axis=0) if n_subsamples else None)
+
+
+#%%
+"""
+Model selection metrics for the elbow sweep
+
+Besides the sum of distance, every k of the sweep gets 
+- the average silhouette width (Rousseeuw 1987), computed for all k together in one blocked pass 
+  over the rows of the already computed distance matrix, so no extra (n, n) memory is needed,
+- the gap statistic (Tibshirani et al 2001), comparing the log sum of distance to that of uniform reference data sets 
+  over the range of each variable, which are generated and clustered in parallel. 
+"""
+
+def silhouette_widths(data, labels, metric="precomputed", block_size=2048):
+    """
+    Silhouette width of every point.
+
+    `data` is the distance matrix, or the census variables with metric="euclidean" (distances are then computed blockwise).
+    `labels` is one label array, or a list of label arrays sharing the same pass over `data`;
+    the result has shape (n,) or (len(labels), n). Silhouettes are NaN when there is a single cluster. 
+    """
+    single = np.ndim(labels[0]) == 0
+    if single:
+        labels = [labels]
+    labels = [np.asarray(l) for l in labels]
+    n = len(labels[0])
+    ks = [int(l.max()) + 1 for l in labels]
+    offsets = np.cumsum([0] + ks)
+    onehot = np.zeros((n, offsets[-1]))
+    for i, l in enumerate(labels):
+        onehot[np.arange(n), offsets[i] + l] = 1
+    counts = onehot.sum(axis=0)
+    if metric != "precomputed":
+        X = np.asarray(data, dtype=np.float64)
+        sq_X = np.einsum("ij,ij->i", X, X)
+
+    widths = np.empty((len(labels), n))
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        if metric == "precomputed":
+            rows = np.asarray(data[start:stop], dtype=np.float64)
+        else:
+            rows = _distances_to(X, X[start:stop], sq_X).T
+        # sum of distances from each point of the block to each cluster, for every labelling
+        sums = rows @ onehot
+        r = np.arange(stop - start)
+        for i, l in enumerate(labels):
+            own = l[start:stop]
+            cnt = counts[offsets[i]:offsets[i + 1]]
+            mean = sums[:, offsets[i]:offsets[i + 1]] / np.maximum(cnt, 1)
+            a = mean[r, own] * cnt[own] / np.maximum(cnt[own] - 1, 1)
+            mean[:, cnt == 0] = np.inf
+            mean[r, own] = np.inf
+            b = mean.min(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                w = (b - a) / np.maximum(a, b)
+            w[cnt[own] == 1] = 0
+            widths[i, start:stop] = w if ks[i] > 1 else np.nan
+    return widths[0] if single else widths
+
+def _reference_log_inertias(lo, hi, n, ks, seed, engine, kwargs):
+    rng = np.random.default_rng(seed)
+    ref = rng.uniform(lo, hi, size=(n, len(lo)))
+    if engine == "precomputed":
+        ref = distance_matrix(ref)
+    return [np.log(fit_kmedoids(ref, k, seed, engine, **kwargs).inertia_) for k in ks]
+
+def gap_statistic(X, inertias, n_refs=10, random_state=10, engine="precomputed", n_jobs=-1, **kwargs):
+    """
+    Gap statistic for every k in `inertias` ({k: sum of distance}, e.g. from the elbow sweep).
+
+    Returns a data frame indexed by k with the gap and its standard error s_k.
+    The reference data sets are clustered with the same engine as the data. 
+    """
+    X = np.asarray(X, dtype=np.float64)
+    ks = sorted(inertias)
+    seeds = np.random.default_rng(random_state).integers(2**31, size=n_refs)
+    ref = Parallel(n_jobs=n_jobs)(delayed(_reference_log_inertias)(X.min(axis=0), X.max(axis=0), len(X), ks, seed, engine, kwargs)
+                                  for seed in seeds)
+    ref = np.array(ref)
+    gap = ref.mean(axis=0) - np.log([inertias[k] for k in ks])
+    sk = ref.std(axis=0) * np.sqrt(1 + 1 / n_refs)
+    return pd.DataFrame({"gap": gap, "gap_sk": sk}, index=pd.Index(ks, name="k"))
+
+def selection_metrics(models, data, X=None, n_refs=10, random_state=10, engine="precomputed", n_jobs=-1, **kwargs):
+    """
+    Sum of distance, average silhouette width and gap statistic for the models of an elbow sweep.
+
+    `data` is what the models were fitted on (the distance matrix for engine="precomputed"),
+    `X` the census variables. With engine="precomputed", X is required for the gap statistic (n_refs > 0),
+    as the uniform reference data sets are drawn over the variables, not over the distance matrix.
+    The "gap_choice" column marks the smallest k with gap(k) >= gap(k+1) - s_(k+1).
+    """
+    if n_refs and engine == "precomputed" and X is None:
+        raise ValueError("the gap statistic needs the census variables X when data is a distance matrix "
+                         "(engine=\"precomputed\"); pass X, or n_refs=0 for the silhouette only")
+    ks = sorted(models)
+    metric = "precomputed" if engine == "precomputed" else "euclidean"
+    widths = silhouette_widths(data, [models[k].labels_ for k in ks], metric=metric)
+    out = pd.DataFrame({"sse": [models[k].inertia_ for k in ks], "silhouette": widths.mean(axis=1)},
+                       index=pd.Index(ks, name="k"))
+    if n_refs:
+        out = out.join(gap_statistic(data if X is None else X, out["sse"].to_dict(), n_refs, random_state, engine, n_jobs, **kwargs))
+        ok = out["gap"] >= (out["gap"] - out["gap_sk"]).shift(-1)
+        out["gap_choice"] = False
+        if ok.any():
+            out.loc[ok.idxmax(), "gap_choice"] = True
+    return out
+
+
+#%%
+"""
+Persisted cluster model
+
+ClusterModel keeps what is needed to label new small areas without refitting: the medoid vectors,
+the order of the variables, and version metadata. assign() labels new rows (e.g. a revised census release
+or scenario-perturbed data) with their nearest medoid in one vectorized pass, in chunks for very large inputs.
+"""
+
+MODEL_VERSION = 1
+
+class ClusterModel:
+    """
+    medoids   : (k, n_variables) medoid vectors, cluster c (1, ..., k) has medoid medoids[c - 1]
+    variables : names of the variables, in the order of the medoid vectors
+    meta      : dict of metadata (format version, creation time, and anything passed to from_fit)
+    """
+
+    def __init__(self, medoids, variables, meta=None):
+        self.medoids = np.asarray(medoids, dtype=np.float64)
+        self.variables = list(variables)
+        self.meta = dict(meta or {})
+
+    @classmethod
+    def from_fit(cls, model, data, **meta):
+        """
+        Model from a fitted k-medoids `model` (any engine) and the data frame of variables it was fitted on
+        """
+        medoids = data.iloc[np.asarray(model.medoid_indices_)].to_numpy(dtype=np.float64)
+        meta = dict({"version": MODEL_VERSION, "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                     "n_clusters": len(medoids), "n_train": len(data), "inertia": float(model.inertia_)}, **meta)
+        return cls(medoids, data.columns, meta)
+
+    def assign(self, data, chunk_size=65536):
+        """
+        cluster1 (1, ..., k) and distance to the nearest medoid of each row of the data frame `data`;
+        rows with a missing or infinite value get cluster1 <NA> and distance NaN
+        """
+        missing = [v for v in self.variables if v not in data.columns]
+        if missing:
+            raise ValueError("data is missing the model variables: %s" % ", ".join(missing))
+        X = (data if list(data.columns) == self.variables else data[self.variables]).to_numpy()
+        labels, dist = _assign(X, self.medoids, chunk_size)
+        cluster1 = pd.array(labels + 1, dtype="Int64")
+        cluster1[labels < 0] = pd.NA
+        return pd.DataFrame({"cluster1": cluster1, "distance": dist}, index=data.index)
+
+    def save(self, path):
+        np.savez(path, medoids=self.medoids, variables=np.array(self.variables), meta=json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f["meta"]))
+            if meta.get("version", MODEL_VERSION) > MODEL_VERSION:
+                raise ValueError("cluster model version %s is newer than this code supports (%d)"
+                                 % (meta["version"], MODEL_VERSION))
+            return cls(f["medoids"], [str(v) for v in f["variables"]], meta)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+File helpers shared by the caches (SAPS csv, shape file arrays, levels of detail, indicator stores).
+
+fingerprint() identifies the version of source files by their path, size and modification time, without reading them.
+replace_directory() writes a folder of files to a temporary folder next to it and then moves it into place,
+so a reader sees either the complete old folder, the complete new one, or none (a cache miss), never a mix.
+"""
+
+import os
+import shutil
+import tempfile
+
+def fingerprint(*paths):
+    """
+    JSON-ready [absolute path, size, modification time in ns] of each file
+    """
+    out = []
+    for path in paths:
+        st = os.stat(path)
+        out.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+    return out
+
+def replace_directory(directory, write):
+    """
+    Call write(folder) on a new temporary folder, then replace `directory` (if any) with it.
+    If the write fails, `directory` is left as it was.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        write(tmp)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    # a non-empty folder cannot be renamed over: move the old one aside first, then delete it
+    trash = None
+    if os.path.exists(directory):
+        trash = tempfile.mkdtemp(dir=parent, prefix=".old-")
+        os.rename(directory, os.path.join(trash, "old"))
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        # written meanwhile by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    if trash is not None:
+        shutil.rmtree(trash, ignore_errors=True)
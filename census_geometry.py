@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Array-backed storage of the census small area boundaries ("Census2016_Small_Areas_generalised20m" shape files).
+
+Instead of one Python list of (x, y) tuples per small area, all boundary vertices are kept in one
+contiguous float64 array, with offset arrays marking where each part (ring) and each shape starts,
+plus the bounding box of each shape. The arrays are cached as .npy files that are memory-mapped on load,
+and the vertices of a single small area are returned as views without copying.
+
+The .shp, .shx and .dbf files are decoded directly with numpy, following the ESRI shapefile specification.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from census_files import fingerprint, replace_directory
+from census_trace import stage
+
+# version of the decoded arrays and attribute table in the cache: bump it when read_shapes or read_dbf change their output
+CACHE_VERSION = 2
+
+class Geometry:
+    """
+    Boundaries of a set of small areas.
+
+    vertices      : (n_vertices, 2) float64 x, y of all parts of all shapes, one after another
+    part_offsets  : (n_parts + 1,) start of each part (ring) in vertices
+    shape_offsets : (n_shapes + 1,) start of each shape's parts in part_offsets
+    bbox          : (n_shapes, 4) xmin, ymin, xmax, ymax of each shape (NaN for empty shapes)
+    records       : data frame of the attributes of each shape (the dbf table)
+    """
+
+    def __init__(self, vertices, part_offsets, shape_offsets, bbox, records, directory=None, meta=None):
+        self.vertices = vertices
+        self.part_offsets = part_offsets
+        self.shape_offsets = shape_offsets
+        self.bbox = bbox
+        self.records = records
+        # cache folder the geometry was loaded from or saved to, where derived arrays can be cached too,
+        # and the fingerprint of the shape files it was read from (to validate those derived arrays)
+        self.directory = directory
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.shape_offsets) - 1
+
+    def coords(self, i):
+        """
+        All vertices of shape i, a (n, 2) view (the same points as pyshp's shape.points)
+        """
+        parts = self.part_offsets[self.shape_offsets[i]:self.shape_offsets[i + 1] + 1]
+        return self.vertices[parts[0]:parts[-1]]
+
+    def parts(self, i):
+        """
+        List of (n, 2) views, one per part (ring) of shape i
+        """
+        parts = self.part_offsets[self.shape_offsets[i]:self.shape_offsets[i + 1] + 1]
+        return [self.vertices[a:b] for a, b in zip(parts[:-1], parts[1:])]
+
+    def part_views(self, index=None):
+        """
+        Views of all parts of the shapes selected by `index` (all shapes by default),
+        and for each part the position in `index` of the shape it belongs to
+        """
+        index = np.arange(len(self)) if index is None else np.asarray(index)
+        start = self.shape_offsets[index]
+        n_parts = self.shape_offsets[index + 1] - start
+        parts = _ranges(start, n_parts)
+        owner = np.repeat(np.arange(len(index)), n_parts)
+        bounds = zip(self.part_offsets[parts], self.part_offsets[parts + 1])
+        return [self.vertices[a:b] for a, b in bounds], owner
+
+    def vertex_counts(self):
+        starts = self.part_offsets[self.shape_offsets]
+        return np.diff(starts)
+
+    def subset(self, index):
+        """
+        New compact Geometry with only the shapes selected by `index` (boolean mask or positions)
+        """
+        index = np.arange(len(self))[np.asarray(index)]
+        part_start, part_stop = self.shape_offsets[index], self.shape_offsets[index + 1]
+        n_parts = part_stop - part_start
+        parts = _ranges(part_start, n_parts)
+        vert_start, vert_stop = self.part_offsets[parts], self.part_offsets[parts + 1]
+        n_verts = vert_stop - vert_start
+        vertices = self.vertices[_ranges(vert_start, n_verts)]
+        part_offsets = np.concatenate([[0], np.cumsum(n_verts)])
+        shape_offsets = np.concatenate([[0], np.cumsum(n_parts)])
+        records = self.records.iloc[index].reset_index(drop=True)
+        return Geometry(vertices, part_offsets, shape_offsets, self.bbox[index], records)
+
+    def to_frame(self):
+        """
+        The records with a "coords" column holding the vertices of each shape (as views),
+        the same layout as the data frame made by read_shapefile in the clustering script.
+        """
+        return self.records.assign(coords=[self.coords(i) for i in range(len(self))])
+
+    def save(self, directory, meta=None):
+        """
+        Write the arrays to `directory`, replacing what was there (with any levels of detail or adjacency
+        cached in it) in one step
+        """
+        def write(folder):
+            for name in ["vertices", "part_offsets", "shape_offsets", "bbox"]:
+                np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+            self.records.to_pickle(os.path.join(folder, "records.pkl"))
+            with open(os.path.join(folder, "meta.json"), "w") as f:
+                json.dump(meta or {}, f)
+        replace_directory(directory, write)
+        self.directory = directory
+        self.meta = meta
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mode = "r" if mmap else None
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode=mode)
+                  for name in ["vertices", "part_offsets", "shape_offsets", "bbox"]]
+        records = pd.read_pickle(os.path.join(directory, "records.pkl"))
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(*arrays, records, directory=directory, meta=meta)
+
+def _ranges(starts, counts):
+    # concatenation of arange(s, s + c) for every start s and count c
+    counts = np.asarray(counts, dtype=np.int64)
+    before = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.repeat(np.asarray(starts, dtype=np.int64) - before, counts) + np.arange(counts.sum())
+
+
+#%%
+"""
+Reading the shape files
+"""
+
+def _encoding(path):
+    # code page of the dbf file, from the .cpg file if any
+    cpg = path + ".cpg"
+    if os.path.exists(cpg):
+        with open(cpg) as f:
+            return f.read().strip() or "utf-8"
+    return "utf-8"
+
+def _dbf_fields(data):
+    # (name, type, start in record, length, decimals) of every field of a dbf file
+    fields = []
+    pos = 1  # first byte of each record is the deletion flag
+    for off in range(32, len(data), 32):
+        if data[off] == 0x0D:
+            break
+        name = bytes(data[off:off + 11]).split(b"\x00")[0].decode("ascii")
+        ftype, length, decimals = chr(data[off + 11]), data[off + 16], data[off + 17]
+        fields.append((name, ftype, pos, length, decimals))
+        pos += length
+    return fields
+
+_LOGICAL = {"Y": True, "T": True, "N": False, "F": False}
+
+def read_dbf(path, columns=None, rows=None):
+    """
+    Attribute table of the shape file `path` (without extension), optionally only some columns and rows.
+    Only the bytes of the requested columns and rows are decoded.
+    Numbers (N, F) are decoded to int64 or float64, dates (D) to datetime64 (NaT when blank) and
+    logicals (L) to True, False or None (unset), as pyshp does.
+    """
+    data = np.memmap(path + ".dbf", dtype=np.uint8, mode="r")
+    n = int(data[4:8].view("<u4")[0])
+    header_len = int(data[8:10].view("<u2")[0])
+    record_len = int(data[10:12].view("<u2")[0])
+    fields = _dbf_fields(data[:header_len])
+    if columns is not None:
+        fields = [f for f in fields if f[0] in columns]
+    table = data[header_len:header_len + n * record_len].reshape(n, record_len)
+    if rows is not None:
+        table = table[np.asarray(rows, dtype=np.int64)]
+    if len(table) == 0:
+        # no record selected: empty columns of the types the fields are decoded to
+        dtypes = {"N": np.int64, "F": np.int64, "D": "datetime64[ns]"}
+        return pd.DataFrame({name: np.array([], dtype=np.float64 if ftype in "NF" and decimals else dtypes.get(ftype, object))
+                             for name, ftype, _, _, decimals in fields}, columns=[f[0] for f in fields])
+    encoding = _encoding(path)
+
+    out = {}
+    for name, ftype, start, length, decimals in fields:
+        raw = np.ascontiguousarray(table[:, start:start + length]).view("S%d" % length).ravel()
+        values = np.char.strip(np.char.decode(raw, encoding, "replace"))
+        if ftype in "NF":
+            values = pd.to_numeric(pd.Series(values).replace("", np.nan), errors="coerce")
+            if decimals == 0 and values.notna().all():
+                values = values.astype(np.int64)
+        elif ftype == "D":
+            values = pd.to_datetime(pd.Series(values), format="%Y%m%d", errors="coerce")
+        elif ftype == "L":
+            values = pd.Series(values).str.upper().map(_LOGICAL).astype(object)
+            values = values.where(values.notna(), None)
+        out[name] = np.asarray(values)
+    return pd.DataFrame(out, columns=[f[0] for f in fields])
+
+def _read_shx(path):
+    # byte offset of every record in the .shp file
+    index = np.fromfile(path + ".shx", dtype=">i4", offset=100).reshape(-1, 2)
+    return index[:, 0].astype(np.int64) * 2
+
+def read_bboxes(path):
+    """
+    Bounding box (xmin, ymin, xmax, ymax) of every shape, read from the record headers only
+    """
+    offsets = _read_shx(path)
+    shp = np.memmap(path + ".shp", dtype=np.uint8, mode="r")
+    # shape type and bounding box are the first 36 bytes after the 8 byte record header
+    idx = np.minimum((offsets + 8)[:, None] + np.arange(36), len(shp) - 1)
+    raw = shp[idx]
+    shape_type = raw[:, :4].copy().view("<i4").ravel()
+    bbox = raw[:, 4:].copy().view("<f8")
+    bbox[shape_type == 0] = np.nan
+    return bbox
+
+def read_shapes(path, which=None):
+    """
+    Decode the polygons of the shape file `path` (without extension) into flat arrays.
+
+    `which` selects records by position; the .shx index is used to jump straight to them.
+    Returns (vertices, part_offsets, shape_offsets, bbox).
+    """
+    offsets = _read_shx(path)
+    if which is not None:
+        offsets = offsets[np.asarray(which)]
+    shp = np.memmap(path + ".shp", dtype=np.uint8, mode="r")
+
+    bbox = np.full((len(offsets), 4), np.nan)
+    n_parts = np.zeros(len(offsets), dtype=np.int64)
+    parts, points = [], []
+    for i, off in enumerate(offsets):
+        start = off + 8  # skip the record header
+        shape_type = int(shp[start:start + 4].view("<i4")[0])
+        if shape_type == 0:
+            continue
+        if shape_type not in (3, 5, 13, 15, 23, 25):
+            raise ValueError("shape type %d is not supported, only polygons and polylines" % shape_type)
+        bbox[i] = shp[start + 4:start + 36].view("<f8")
+        nparts, npoints = shp[start + 36:start + 44].view("<i4")
+        p = start + 44 + 4 * nparts
+        parts.append(shp[start + 44:p].view("<i4"))
+        points.append(shp[p:p + 16 * npoints].view("<f8").reshape(-1, 2))
+        n_parts[i] = nparts
+
+    vertices = np.concatenate(points) if points else np.zeros((0, 2))
+    sizes = np.array([len(v) for v in points], dtype=np.int64)
+    vertex_base = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    part_starts = np.concatenate([np.asarray(pt, dtype=np.int64) + base for pt, base in zip(parts, vertex_base)]) \
+        if parts else np.zeros(0, dtype=np.int64)
+    part_offsets = np.concatenate([part_starts, [len(vertices)]])
+    shape_offsets = np.concatenate([[0], np.cumsum(n_parts)])
+    return vertices, part_offsets, shape_offsets, bbox
+
+def _fingerprint(path):
+    return {"files": fingerprint(path + ".shp", path + ".shx", path + ".dbf"), "version": CACHE_VERSION}
+
+def read_geometry(path, cache=True, cache_dir=None):
+    """
+    Load the shape file `path` (without extension, as for shapefile.Reader) as a Geometry.
+
+    The arrays are cached in the ".census_cache" folder next to the shape file and memory-mapped on later loads;
+    the cache is rebuilt automatically whenever the shape files change.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".census_cache")
+    directory = os.path.join(cache_dir, os.path.basename(path) + ".geometry")
+    meta_path = os.path.join(directory, "meta.json")
+    with stage("shapefile read", file=os.path.basename(path)) as s:
+        if cache and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) == _fingerprint(path):
+                    geometry = Geometry.load(directory)
+                    s.set(shapes=len(geometry), cached=True)
+                    return geometry
+
+        geometry = Geometry(*read_shapes(path), read_dbf(path))
+        if cache:
+            geometry.save(directory, meta=_fingerprint(path))
+        s.set(shapes=len(geometry), cached=False)
+    return geometry
+
+def read_region(path, where=None, bbox=None):
+    """
+    Load only the small areas of the shape file `path` matching a filter, as a Geometry.
+
+    `where` maps dbf columns to allowed values, e.g. {"COUNTYNAME": ["Fingal", "Dublin City"]};
+    only those dbf columns are scanned to evaluate it.
+    `bbox` = (xmin, ymin, xmax, ymax) keeps the shapes whose bounding box intersects it,
+    using the bounding boxes stored in the record headers.
+    Only the boundaries and attributes of the matching records are decoded, located through the .shx index. 
+    """
+    mask = None
+    if where:
+        table = read_dbf(path, columns=list(where))
+        mask = np.logical_and.reduce([table[col].isin(values).to_numpy() for col, values in where.items()])
+    if bbox is not None:
+        boxes = read_bboxes(path)
+        xmin, ymin, xmax, ymax = bbox
+        inside = (boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)
+        mask = inside if mask is None else mask & inside
+    which = None if mask is None else np.flatnonzero(mask)
+    with stage("shapefile read region", file=os.path.basename(path), shapes=None if which is None else len(which)):
+        return Geometry(*read_shapes(path, which), read_dbf(path, rows=which))
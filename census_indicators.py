@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative definitions of the 69 summary census variables used in the paper:
+    Hu et al (2020), "A spatial machine learning model for analyzing customers' lapse behaviour in life insurance", Annals of Actuarial Science.
+
+Every summary variable is a ratio of two weighted sums of raw SAPS columns, times a scale:
+    indicator = scale * sum(w_i * numerator_i) / sum(v_j * denominator_j)
+
+The definitions are compiled once into a numerator and a denominator weight matrix,
+so all 69 variables are computed in a single vectorized pass over the raw SAPS array
+instead of one temporary Series per variable.
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from census_files import fingerprint, replace_directory
+from census_keys import SAKeys, normalize_said, left_join
+from census_trace import stage
+
+Indicator = namedtuple("Indicator", ["name", "theme", "numerator", "denominator", "scale"])
+
+def _sum(*cols):
+    return {c: 1 for c in cols}
+
+# weighted count of rooms, shared by Rooms and PeopleRoom
+_ROOMS = {"T6_4_1RH": 1, "T6_4_2RH": 2, "T6_4_3RH": 3, "T6_4_4RH": 4,
+          "T6_4_5RH": 5, "T6_4_6RH": 6, "T6_4_7RH": 7, "T6_4_GE8RH": 8}
+
+INDICATORS = [
+    # * Demographic information *
+    # age
+    Indicator("Age0_4", "Demographic", _sum("T1_1AGE0T", "T1_1AGE1T", "T1_1AGE2T", "T1_1AGE3T", "T1_1AGE4T"), _sum("T1_1AGETT"), 100),
+    Indicator("Age5_14", "Demographic", _sum("T1_1AGE5T", "T1_1AGE6T", "T1_1AGE7T", "T1_1AGE8T", "T1_1AGE9T", "T1_1AGE10T",
+                                             "T1_1AGE11T", "T1_1AGE12T", "T1_1AGE13T", "T1_1AGE14T"), _sum("T1_1AGETT"), 100),
+    Indicator("Age25_44", "Demographic", _sum("T1_1AGE25_29T", "T1_1AGE30_34T", "T1_1AGE35_39T", "T1_1AGE40_44T"), _sum("T1_1AGETT"), 100),
+    Indicator("Age45_64", "Demographic", _sum("T1_1AGE45_49T", "T1_1AGE50_54T", "T1_1AGE55_59T", "T1_1AGE60_64T"), _sum("T1_1AGETT"), 100),
+    Indicator("Age65over", "Demographic", _sum("T1_1AGE65_69T", "T1_1AGE70_74T", "T1_1AGE75_79T", "T1_1AGE80_84T", "T1_1AGEGE_85T"), _sum("T1_1AGETT"), 100),
+    # nationality
+    Indicator("EU_National", "Demographic", _sum("T2_1UKN", "T2_1PLN", "T2_1LTN", "T2_1EUN"), _sum("T2_1TN"), 100),
+    Indicator("ROW_National", "Demographic", _sum("T2_1RWN"), _sum("T2_1TN"), 100),
+    Indicator("Born_outside_Ireland", "Demographic", {"T2_1TBP": 1, "T2_1IEBP": -1}, _sum("T2_1TBP"), 100),
+    Indicator("Minority", "Demographic", _sum("T2_2BBI", "T2_2AAI", "T2_2OTH"), _sum("T2_2T"), 100),
+    Indicator("English", "Demographic", _sum("T2_6NW", "T2_6NAA"), _sum("T2_6T"), 100),
+
+    # * Household Composition *
+    # marrital status
+    Indicator("Separated", "Household", _sum("T1_2SEPT", "T1_2DIVT"), _sum("T1_2T"), 100),
+    Indicator("Married", "Household", _sum("T1_2MART"), _sum("T1_2T"), 100),
+    Indicator("Single", "Household", _sum("T1_2SGLT", "T1_2WIDT"), _sum("T1_2T"), 100),
+    # family (cycle) type
+    Indicator("Dink", "Household", _sum("T4_5PFF"), _sum("T4_5TF"), 100),
+    Indicator("Pensioner", "Household", _sum("T4_5RP"), _sum("T4_5TP"), 100),  # retired person
+    Indicator("LoneParent", "Household", _sum("T4_3FOPMCT", "T4_3FOPFCT"), _sum("T4_4TF"), 100),
+    Indicator("NonDependentKids", "Household", _sum("T4_4AGE_GE20F"), _sum("T4_4TF"), 100),
+    Indicator("EmptyNest", "Household", _sum("T4_5ENF"), _sum("T4_5TF"), 100),
+    Indicator("NoChildrenFam", "Household", _sum("T4_2_NCT"), _sum("T4_2_TCT"), 100),
+    # household
+    Indicator("SinglePersonFam", "Household", _sum("T5_2_1PP"), _sum("T5_2_TP"), 100),
+    Indicator("HouseShare", "Household", _sum("T5_1GETFU_H", "T5_1NHR_H", "T5_1GENP_H"), _sum("T5_1T_H"), 100),
+
+    # * Housing *
+    # household by type of accommodation
+    Indicator("House", "Housing", _sum("T6_1_HB_H"), _sum("T6_1_TH"), 100),
+    Indicator("Flats", "Housing", _sum("T6_1_FA_H"), _sum("T6_1_TH"), 100),
+    # household by type of occupancy
+    Indicator("RentPublic", "Housing", _sum("T6_3_RLAH"), _sum("T6_3_TH"), 100),
+    Indicator("RentPrivate", "Housing", _sum("T6_3_RPLH"), _sum("T6_3_TH"), 100),
+    Indicator("OwnedMortgage", "Housing", _sum("T6_3_OMLH"), _sum("T6_3_TH"), 100),
+    Indicator("Owned", "Housing", _sum("T6_3_OOH"), _sum("T6_3_TH"), 100),
+    # household by number of rooms
+    Indicator("Rooms", "Housing", _ROOMS, _sum("T6_4_TH"), 1),
+    Indicator("PeopleRoom", "Housing", _sum("T1_1AGETT"), _ROOMS, 1),
+    # household by central heating
+    Indicator("NoCenHeat", "Housing", _sum("T6_5_NCH"), _sum("T6_5_T"), 100),
+    # household by sewerage facility
+    Indicator("SepticTank", "Housing", _sum("T6_7_IST"), _sum("T6_7_T"), 100),
+
+    # * Socio-economic information *
+    # higher education to degree or higher
+    Indicator("HE", "Socio-economic", _sum("T10_4_ODNDT", "T10_4_HDPQT", "T10_4_PDT", "T10_4_DT"), _sum("T10_4_TT"), 100),
+    # HE field of study: STEM, HASS, Health+Medicine
+    Indicator("HEstem", "Socio-economic", _sum("T10_3_SCIT", "T10_3_ENGT"), _sum("T10_3_TT"), 100),
+    Indicator("HEhass", "Socio-economic", _sum("T10_3_ARTT", "T10_3_HUMT", "T10_3_SOCT"), _sum("T10_3_TT"), 100),
+    Indicator("HEhealth", "Socio-economic", _sum("T10_3_HEAT", "T10_3_AGRT"), _sum("T10_3_TT"), 100),
+    # principle status: employment
+    Indicator("Employed", "Socio-economic", _sum("T8_1_WT"), _sum("T8_1_TT"), 100),
+    # number of cars: more than two cars
+    Indicator("TwoCars", "Socio-economic", _sum("T15_1_2C", "T15_1_3C", "T15_1_GE4C"),
+              _sum("T15_1_NC", "T15_1_1C", "T15_1_2C", "T15_1_3C", "T15_1_GE4C"), 100),
+    # journey to work/college
+    Indicator("JTWpublic", "Socio-economic", _sum("T11_1_BUT", "T11_1_TDLT"), _sum("T11_1_TT"), 100),
+    Indicator("JTWcar", "Socio-economic", _sum("T11_1_CDT", "T11_1_CPT"), _sum("T11_1_TT"), 100),
+    Indicator("JTWvan", "Socio-economic", _sum("T11_1_VT"), _sum("T11_1_TT"), 100),
+    Indicator("JTWhome", "Socio-economic", _sum("T11_1_WMFHT"), _sum("T11_1_TT"), 100),
+    # health: bad and very bad general health status
+    Indicator("Health", "Socio-economic", _sum("T12_3_BT", "T12_3_VBT"), _sum("T12_3_TT"), 100),
+    # social class (on the basis of occupation)
+    Indicator("SC_professional", "Socio-economic", _sum("T9_1_PWT"), _sum("T9_1_TT"), 100),
+    Indicator("SC_managerial", "Socio-economic", _sum("T9_1_MTT"), _sum("T9_1_TT"), 100),
+    Indicator("SC_nonmanual", "Socio-economic", _sum("T9_1_NMT"), _sum("T9_1_TT"), 100),
+    Indicator("SC_skilled", "Socio-economic", _sum("T9_1_ST"), _sum("T9_1_TT"), 100),
+    Indicator("SC_semi", "Socio-economic", _sum("T9_1_SST"), _sum("T9_1_TT"), 100),
+    Indicator("SC_unskilled", "Socio-economic", _sum("T9_1_UST"), _sum("T9_1_TT"), 100),
+    # socio-economic group (on the basis of skills and education)
+    Indicator("Employer", "Socio-economic", _sum("T9_2_PA"), _sum("T9_2_PT"), 100),
+    Indicator("HighProfessional", "Socio-economic", _sum("T9_2_PB"), _sum("T9_2_PT"), 100),
+    Indicator("LowProfessional", "Socio-economic", _sum("T9_2_PC"), _sum("T9_2_PT"), 100),
+    Indicator("Nonmanual", "Socio-economic", _sum("T9_2_PD"), _sum("T9_2_PT"), 100),
+    Indicator("Skilled", "Socio-economic", _sum("T9_2_PE"), _sum("T9_2_PT"), 100),
+    Indicator("Semiskilled", "Socio-economic", _sum("T9_2_PF"), _sum("T9_2_PT"), 100),
+    Indicator("Unskilled", "Socio-economic", _sum("T9_2_PG"), _sum("T9_2_PT"), 100),
+    Indicator("HomeWork", "Socio-economic", _sum("T9_2_PH"), _sum("T9_2_PT"), 100),
+    Indicator("Farmer", "Socio-economic", _sum("T9_2_PI"), _sum("T9_2_PT"), 100),
+
+    # * Employment *
+    Indicator("Students", "Employment", _sum("T8_1_ST"), _sum("T8_1_TT"), 100),
+    Indicator("Unemployed", "Employment", _sum("T8_1_ULGUPJT", "T8_1_LFFJT"), _sum("T8_1_TT"), 100),
+    Indicator("EconInactFam", "Employment", _sum("T8_1_LAHFT"), _sum("T8_1_TT"), 100),
+    # occupation industry
+    Indicator("Agric", "Employment", _sum("T14_1_AFFT"), _sum("T14_1_TT"), 100),
+    Indicator("Construction", "Employment", _sum("T14_1_BCT"), _sum("T14_1_TT"), 100),
+    Indicator("Manufacturing", "Employment", _sum("T14_1_MIT"), _sum("T14_1_TT"), 100),
+    Indicator("Commerce", "Employment", _sum("T14_1_CTT"), _sum("T14_1_TT"), 100),
+    Indicator("Transport", "Employment", _sum("T14_1_TCT"), _sum("T14_1_TT"), 100),
+    Indicator("Public", "Employment", _sum("T14_1_PAT"), _sum("T14_1_TT"), 100),
+    Indicator("Professional", "Employment", _sum("T14_1_PST"), _sum("T14_1_TT"), 100),
+
+    # * Misc *
+    # internet connected households with broadband
+    Indicator("Broadband", "Misc", _sum("T15_3_B"), _sum("T15_3_B", "T15_3_OTH"), 100),
+    # households with internet
+    Indicator("Internet", "Misc", _sum("T15_3_B", "T15_3_OTH"), _sum("T15_3_T"), 100),
+]
+
+INDICATOR_NAMES = [ind.name for ind in INDICATORS]
+
+
+CompiledIndicators = namedtuple("CompiledIndicators", ["names", "columns", "numerator", "denominator", "scale", "themes"])
+
+def compile_indicators(indicators=INDICATORS):
+    """
+    Compile indicator definitions into weight matrices.
+
+    Returns the indicator names, the ordered raw SAPS columns they need,
+    numerator and denominator matrices of shape (n_columns, n_indicators),
+    the scale vector and the theme of each indicator.
+    """
+    columns = []
+    position = {}
+    for ind in indicators:
+        for col in list(ind.numerator) + list(ind.denominator):
+            if col not in position:
+                position[col] = len(columns)
+                columns.append(col)
+
+    numerator = np.zeros((len(columns), len(indicators)))
+    denominator = np.zeros((len(columns), len(indicators)))
+    for j, ind in enumerate(indicators):
+        for col, w in ind.numerator.items():
+            numerator[position[col], j] = w
+        for col, w in ind.denominator.items():
+            denominator[position[col], j] = w
+    scale = np.array([ind.scale for ind in indicators], dtype=float)
+    return CompiledIndicators([ind.name for ind in indicators], columns, numerator, denominator, scale,
+                              [ind.theme for ind in indicators])
+
+_COMPILED = compile_indicators()
+
+def compute_indicators(df, compiled=None, index=None, dtype=np.float64):
+    """
+    Compute all summary variables of the raw SAPS table `df` in one pass (one matrix product per theme,
+    so each theme is a traced stage, see census_trace.py). With dtype=np.float32 the result is half the size
+    (the ratios are still computed in float64).
+
+    Zero denominators give inf/NaN, as the hand-written pandas expressions did (see census_store.py
+    to count and mask them).
+    """
+    if compiled is None:
+        compiled = _COMPILED
+    raw = df[compiled.columns].to_numpy(dtype=np.float64)
+    values = np.empty((len(raw), len(compiled.names)), dtype=dtype)
+    themes = np.array(compiled.themes)
+    for theme in dict.fromkeys(compiled.themes):
+        cols = np.flatnonzero(themes == theme)
+        with stage("indicators " + theme, rows=len(raw), indicators=len(cols)):
+            num = raw @ compiled.numerator[:, cols]
+            den = raw @ compiled.denominator[:, cols]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values[:, cols] = compiled.scale[cols] * num / den
+    return pd.DataFrame(values, columns=compiled.names, index=df.index if index is None else index)
+
+
+#%%
+"""
+Loading the raw SAPS table
+
+Only the columns needed by the indicator definitions are parsed, as compact int32 counts.
+The parsed table is cached as memory-mappable .npy arrays next to a small json file
+recording the size and modification time of the source csv, so later runs skip the csv parse
+and the cache is rebuilt automatically whenever the csv changes. 
+The cache of a csv holds every column requested from it so far, so callers needing different columns
+(e.g. the releases of census_panel.py) share it instead of replacing each other's.
+"""
+
+SAPS_KEY = "GEOGID"
+
+def required_columns(indicators=INDICATORS):
+    return compile_indicators(indicators).columns
+
+def _cache_directory(path, cache_dir):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".census_cache")
+    return os.path.join(cache_dir, stem + ".saps")
+
+def _read_cache(path, columns, key, cache_dir):
+    """
+    (data frame of the key and `columns`, or None if they are not all cached; the columns cached for this csv)
+    """
+    directory = _cache_directory(path, cache_dir)
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None, []
+    if meta["fingerprint"] != fingerprint(path) or meta["key"] != key:
+        return None, []
+    if not set(columns) <= set(meta["columns"]):
+        return None, meta["columns"]
+    counts = np.load(os.path.join(directory, "counts.npy"), mmap_mode="r")
+    keys = np.load(os.path.join(directory, "keys.npy"))
+    # the requested columns in the requested order (a memory-mapped view if that is the cached layout)
+    if columns != meta["columns"]:
+        position = {c: j for j, c in enumerate(meta["columns"])}
+        counts = counts[:, [position[c] for c in columns]]
+    df = pd.DataFrame(counts, columns=columns)
+    df.insert(0, key, keys.astype(object))
+    return df, meta["columns"]
+
+def _write_cache(path, df, columns, key, cache_dir):
+    def write(directory):
+        np.save(os.path.join(directory, "counts.npy"), np.ascontiguousarray(df[columns].to_numpy()))
+        np.save(os.path.join(directory, "keys.npy"), df[key].to_numpy(dtype=str))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"fingerprint": fingerprint(path), "key": key, "columns": list(columns)}, f)
+    replace_directory(_cache_directory(path, cache_dir), write)
+
+def load_saps(path, columns=None, key=SAPS_KEY, cache=True, cache_dir=None):
+    """
+    Load the small area key and the census count columns used by the indicators.
+
+    `columns` defaults to the columns required by INDICATORS. 
+    Set cache=False to always parse the csv. 
+    """
+    if columns is None:
+        columns = required_columns()
+    columns = list(dict.fromkeys(columns))
+    parse = columns
+    with stage("csv read", file=os.path.basename(path), columns=len(columns)) as s:
+        if cache:
+            df, cached = _read_cache(path, columns, key, cache_dir)
+            if df is not None:
+                s.set(rows=len(df), cached=True)
+                return df
+            # parse the cached columns again too, so the cache keeps them
+            parse = cached + [c for c in columns if c not in set(cached)]
+        dtypes = {c: np.int32 for c in parse}
+        dtypes[key] = str
+        df = pd.read_csv(path, usecols=[key] + parse, dtype=dtypes)
+        if cache:
+            _write_cache(path, df, parse, key, cache_dir)
+        df = df[[key] + columns]
+        s.set(rows=len(df), cached=False)
+    return df
+
+
+#%%
+"""
+Streaming extraction
+
+Reads the SAPS csv(s) in chunks of rows, computes the summary variables per chunk, 
+joins each chunk to the county names of the "Small_Areas_Boundaries_2015" key table
+and appends it to the output csv, so memory is bounded by the chunk size rather than the file size. 
+The output has the same layout as saving the merged "Ireland" (or "Dublin") data frame in the extraction script. 
+"""
+
+def extract_in_chunks(saps_paths, refkey_path, out_path, counties=None, chunksize=2000, key=SAPS_KEY):
+    """
+    Returns the number of small areas written to `out_path`.
+
+    `saps_paths` is one csv file or a list of them, which are appended one after another. 
+    If `counties` is given, only small areas in those counties are written. 
+    Empty (or header-only) csv files add no rows; the header is written even if no file has any.
+    """
+    if isinstance(saps_paths, str):
+        saps_paths = [saps_paths]
+    columns = required_columns()
+    refkey = pd.read_csv(refkey_path, usecols=["COUNTYNAME", "SMALL_AREA"], dtype=str)[["COUNTYNAME", "SMALL_AREA"]]
+    keys = SAKeys(refkey["SMALL_AREA"])
+    keys.add_table("refkey", refkey["SMALL_AREA"])
+
+    dtypes = {c: np.int32 for c in columns}
+    dtypes[key] = str
+
+    def summarize(chunk):
+        part = compute_indicators(chunk)
+        part["SAID"] = normalize_said(chunk[key])
+        part = left_join(part, refkey, keys.rows("refkey", part["SAID"]))
+        if counties is not None:
+            part = part[part["COUNTYNAME"].isin(counties)]
+        return part
+
+    offset = 0
+    written = 0
+    header = True
+    with open(out_path, "w", newline="", encoding="utf-8") as out:
+        for path in saps_paths:
+            try:
+                reader = pd.read_csv(path, usecols=[key] + columns, dtype=dtypes, chunksize=chunksize)
+            except pd.errors.EmptyDataError:
+                continue
+            rows = 0
+            for chunk in reader:
+                chunk.index = chunk.index + offset
+                rows += len(chunk)
+                part = summarize(chunk)
+                part.to_csv(out, header=header)
+                header = False
+                written += len(part)
+            offset += rows
+        if header:
+            empty = pd.DataFrame({c: pd.Series(dtype=dtypes[c]) for c in [key] + columns})
+            summarize(empty).to_csv(out)
+    return written
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Integer-coded small area IDs (SAID) and an indexed join layer.
+
+The census table identifies small areas by GEOGID ("SA2017_017001001"), the boundary key table and the shape files
+by SMALL_AREA ("017001001"). SAKeys normalises these IDs with vectorized string operations, and gives every distinct
+ID a compact int32 code (its position in the sorted list of IDs). For each registered table it keeps an array giving
+the row of every code, so joining two tables is an array gather instead of a merge on string columns.
+The registry (IDs and row indexes) can be saved to and loaded from a .npz file.
+"""
+
+import numpy as np
+import pandas as pd
+
+from census_trace import stage
+
+def normalize_said(values):
+    """
+    Small area IDs without the "SA2017_" style prefix, as a numpy string array
+    """
+    return pd.Series(values).astype(str).str.replace(r"^SA\d*_", "", regex=True).str.strip().to_numpy(dtype=str)
+
+class SAKeys:
+    """
+    Registry of small area IDs.
+
+    ids    : sorted array of the distinct (normalised) IDs, the code of an ID is its position
+    tables : {table name: array giving the row of each code in that table, -1 if absent}
+    """
+
+    def __init__(self, *columns):
+        ids = [normalize_said(c) for c in columns]
+        self.ids = np.unique(np.concatenate(ids)) if ids else np.zeros(0, dtype=str)
+        self.tables = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, values):
+        """
+        int32 codes of the IDs `values`, -1 for IDs not in the registry
+        """
+        values = normalize_said(values)
+        if len(self.ids) == 0:
+            return np.full(len(values), -1, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self.ids, values), len(self.ids) - 1)
+        return np.where(self.ids[pos] == values, pos, -1).astype(np.int32)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        return np.where(codes >= 0, self.ids[np.maximum(codes, 0)], None)
+
+    def add_table(self, name, values):
+        """
+        Register a table by its column of IDs; if an ID appears in several rows, the first row is used
+        """
+        codes = self.encode(values)
+        rows = np.full(len(self.ids), -1, dtype=np.int64)
+        known = np.flatnonzero(codes >= 0)
+        # assign in reverse so the first row of a repeated ID wins
+        rows[codes[known[::-1]]] = known[::-1]
+        self.tables[name] = rows
+        return codes
+
+    def rows(self, name, values=None, codes=None):
+        """
+        Row in table `name` of each ID in `values` (or of each code in `codes`), -1 if absent
+        """
+        if codes is None:
+            codes = self.encode(values)
+        codes = np.asarray(codes)
+        if len(self.ids) == 0:
+            return np.full(len(codes), -1, dtype=np.int64)
+        return np.where(codes >= 0, self.tables[name][np.maximum(codes, 0)], -1)
+
+    def save(self, path):
+        np.savez(path, ids=self.ids, **{"table_" + name: rows for name, rows in self.tables.items()})
+
+    @classmethod
+    def load(cls, path):
+        keys = cls()
+        with np.load(path) as f:
+            keys.ids = f["ids"]
+            keys.tables = {name[6:]: f[name] for name in f.files if name.startswith("table_")}
+        return keys
+
+def left_join(left, right, rows):
+    """
+    Append the columns of `right` at row positions `rows` (from SAKeys.rows) to `left`; -1 gives missing values.
+    Equivalent to pd.merge(left, right, how='left') on the small area ID when right has one row per ID.
+    """
+    with stage("left join", left=len(left), right=len(right)):
+        right = right.reset_index(drop=True).reindex(rows)
+        right.index = left.index
+        return pd.concat([left, right], axis=1)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Maps of the small areas and of their census clusters, as in the paper:
+    Hu et al (2020), "A spatial machine learning model for analyzing customers' lapse behaviour in life insurance", Annals of Actuarial Science.
+
+All boundaries are drawn as one LineCollection and all filled small areas as one PathCollection,
+built from the flat arrays of a census_geometry.Geometry, instead of one matplotlib artist per small area.
+Each small area is filled as one compound path of all its rings, so holes (e.g. around an enclave) stay unfilled.
+When x_lim and y_lim are given, only the small areas whose bounding box intersects them are drawn.
+With lod=True (the default) the boundaries are drawn from the coarsest level of detail (census_simplify.py)
+whose simplification stays below one pixel at the figure size and dpi, so overview maps draw far fewer vertices.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.path import Path
+
+from census_simplify import choose_level
+from census_trace import stage
+
+# set the color palette, consistent with the plots in the paper
+my_color = ['thistle', 'burlywood', 'palegoldenrod', 'lightpink', 'paleturquoise', 'lightgrey', 'lightsteelblue', 'darkseagreen']
+
+def _visible(geometry, index, x_lim, y_lim):
+    # positions (in geometry) of the selected shapes intersecting the plotting window
+    index = np.arange(len(geometry)) if index is None else np.asarray(index)
+    if x_lim is None or y_lim is None:
+        return index
+    box = geometry.bbox[index]
+    keep = (box[:, 0] <= x_lim[1]) & (box[:, 2] >= x_lim[0]) & (box[:, 1] <= y_lim[1]) & (box[:, 3] >= y_lim[0])
+    return index[keep]
+
+def _detail(geometry, index, x_lim, y_lim, figsize, lod, dpi):
+    # level of detail to draw the shapes `index` with
+    if not lod or len(index) == 0:
+        return geometry
+    if x_lim is not None and y_lim is not None:
+        extent = (x_lim[0], y_lim[0], x_lim[1], y_lim[1])
+    else:
+        box = geometry.bbox[index]
+        extent = (np.nanmin(box[:, 0]), np.nanmin(box[:, 1]), np.nanmax(box[:, 2]), np.nanmax(box[:, 3]))
+    # size of the axes (not the whole figure) in inches
+    size = (figsize[0] * (plt.rcParams["figure.subplot.right"] - plt.rcParams["figure.subplot.left"]),
+            figsize[1] * (plt.rcParams["figure.subplot.top"] - plt.rcParams["figure.subplot.bottom"]))
+    return choose_level(geometry, extent, size, dpi or plt.rcParams["figure.dpi"])
+
+def _shape_paths(geometry, index):
+    # one compound path per shape, starting a new subpath (MOVETO) at each of its parts
+    part_offsets = np.asarray(geometry.part_offsets)
+    codes = np.full(len(geometry.vertices), Path.LINETO, dtype=Path.code_type)
+    codes[part_offsets[:-1][np.diff(part_offsets) > 0]] = Path.MOVETO
+    starts = part_offsets[geometry.shape_offsets[index]]
+    stops = part_offsets[geometry.shape_offsets[index + 1]]
+    return [Path(geometry.vertices[a:b], codes[a:b]) for a, b in zip(starts, stops)]
+
+def _set_limits(ax, geometry, index, x_lim, y_lim):
+    if x_lim is not None and y_lim is not None:
+        ax.set_xlim(x_lim)
+        ax.set_ylim(y_lim)
+    elif len(index):
+        box = geometry.bbox[index]
+        ax.set_xlim(np.nanmin(box[:, 0]), np.nanmax(box[:, 2]))
+        ax.set_ylim(np.nanmin(box[:, 1]), np.nanmax(box[:, 3]))
+
+def plot_boundaries(geometry, index=None, x_lim=None, y_lim=None, figsize=(9, 11), lod=True, dpi=None):
+    """
+    Plot the boundaries of the small areas selected by `index` (positions in geometry, all by default)
+    """
+    with stage("map boundaries", shapes=len(geometry) if index is None else len(index)):
+        fig, ax = plt.subplots(figsize=figsize)
+        index = _visible(geometry, index, x_lim, y_lim)
+        parts, _ = _detail(geometry, index, x_lim, y_lim, figsize, lod, dpi).part_views(index)
+        ax.add_collection(LineCollection(parts, colors="k", linestyles=":", alpha=.9))
+        _set_limits(ax, geometry, index, x_lim, y_lim)
+    return fig, ax
+
+def plot_cluster_map(geometry, clusters, index=None, x_lim=None, y_lim=None,
+                     figsize=(12, 15), legend=True, color=my_color, lod=True, dpi=None):
+    """
+    Fill each small area with the colour of its cluster.
+
+    `clusters` gives the cluster (1, 2, ...) of each selected small area, NaN for small areas without cluster
+    (their boundary is drawn but they are not filled). `index` selects small areas by position in geometry.
+    """
+    with stage("map clusters", shapes=len(geometry) if index is None else len(index)):
+        return _plot_cluster_map(geometry, clusters, index, x_lim, y_lim, figsize, legend, color, lod, dpi)
+
+def _plot_cluster_map(geometry, clusters, index, x_lim, y_lim, figsize, legend, color, lod, dpi):
+    fig, ax = plt.subplots(figsize=figsize)
+    index = np.arange(len(geometry)) if index is None else np.asarray(index)
+    clusters = np.asarray(clusters, dtype=float)
+    position = np.full(len(geometry), -1)
+    position[index] = np.arange(len(index))
+    index = _visible(geometry, index, x_lim, y_lim)
+    clusters = clusters[position[index]]
+
+    palette = to_rgba_array(color)
+    facecolors = np.zeros((len(index), 4))
+    filled = np.isfinite(clusters) & (clusters >= 1) & (clusters <= len(color))
+    facecolors[filled] = palette[clusters[filled].astype(int) - 1]
+
+    level = _detail(geometry, index, x_lim, y_lim, figsize, lod, dpi)
+    parts, _ = level.part_views(index)
+    ax.add_collection(LineCollection(parts, colors="k", linestyles="--", alpha=0.07))
+    ax.add_collection(PathCollection(_shape_paths(level, index), facecolors=facecolors, edgecolors="none"))
+
+    if legend:
+        f = lambda m, c: ax.plot([], [], marker=m, color=c, ls="none")[0]
+        handles = [f("s", c) for c in color]
+        labels = ['Cluster %d' % (i + 1) for i in range(len(color))]
+        ax.legend(handles, labels, loc='lower right', frameon=False,
+                  markerscale=4, fontsize='xx-large', bbox_to_anchor=(1.3, 0))
+
+    _set_limits(ax, geometry, index, x_lim, y_lim)
+    return fig, ax
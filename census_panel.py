@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Panel of the summary variables over several census releases (e.g. 2011, 2016 and 2022), on common small areas.
+
+Each release is described by a CensusRelease:
+    year            census year
+    saps_path       its SAPS small area csv
+    columns         {column code in INDICATORS (2016 codes): column code in this release}, for the codes that differ
+    correspondence  csv of the small area boundary revisions, mapping this release's small areas to the reference ones,
+                    with columns from_said, to_said and weight (the share of the counts of from_said going to to_said,
+                    e.g. 1 for unchanged or merged areas, population shares for split areas); areas not listed are unchanged
+    key             the small area ID column (GEOGID)
+
+The raw counts are moved to the reference small areas before the ratios are computed, so the summary variables of
+all years are comparable. Indicators needing a column a release does not have are NaN for that year (see
+CensusPanel.missing). A year is only read when it is first queried, and its summary variables are cached on disk
+by a stage_cache.StageCache, keyed by the files, the column map and the indicator definitions.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from census_indicators import INDICATORS, INDICATOR_NAMES, SAPS_KEY, compile_indicators, compute_indicators, load_saps
+from census_keys import SAKeys, normalize_said
+from census_trace import stage
+from stage_cache import StageCache, hash_value
+
+# version of release_indicators, part of the cache key of each year: bump it whenever its result changes
+PANEL_VERSION = 1
+
+CensusRelease = namedtuple("CensusRelease", ["year", "saps_path", "columns", "correspondence", "key"],
+                           defaults=(None, None, SAPS_KEY))
+
+def read_correspondence(path):
+    table = pd.read_csv(path, dtype={"from_said": str, "to_said": str})
+    if "weight" not in table.columns:
+        table["weight"] = 1.0
+    return table[["from_said", "to_said", "weight"]]
+
+def harmonize(counts, said, correspondence):
+    """
+    Counts (rows of `said`) moved to the reference small areas through a correspondence table.
+    Returns the (n_reference, n_columns) float counts and the reference IDs.
+    """
+    said = normalize_said(said)
+    from_ids = normalize_said(correspondence["from_said"])
+    keys = SAKeys(said)
+    keys.add_table("release", said)
+    rows = keys.rows("release", from_ids)
+    known = rows >= 0
+    listed = np.zeros(len(said), dtype=bool)
+    listed[rows[known]] = True
+    targets = np.concatenate([normalize_said(correspondence["to_said"])[known], said[~listed]])
+    sources = np.concatenate([rows[known], np.flatnonzero(~listed)])
+    weights = np.concatenate([correspondence["weight"].to_numpy(dtype=np.float64)[known], np.ones((~listed).sum())])
+    reference, target = np.unique(targets, return_inverse=True)
+    W = sp.csr_matrix((weights, (target.ravel(), sources)), shape=(len(reference), len(said)))
+    return W @ np.asarray(counts, dtype=np.float64), reference
+
+def release_indicators(release, indicators=INDICATORS):
+    """
+    Summary variables of one release, indexed by reference small area ID (SAID)
+    """
+    compiled = compile_indicators(indicators)
+    renames = dict(release.columns or {})
+    source = [renames.get(c, c) for c in compiled.columns]
+    header = pd.read_csv(release.saps_path, nrows=0).columns
+    present = [s in header for s in source]
+    available = [s for s, p in zip(source, present) if p]
+    df = load_saps(release.saps_path, columns=list(dict.fromkeys(available)), key=release.key)
+    counts = np.zeros((len(df), len(source)))
+    # taken by name, not by position (a column map can also point several codes at one column)
+    counts[:, np.flatnonzero(present)] = df[available].to_numpy()
+    said = normalize_said(df[release.key])
+    if release.correspondence is not None:
+        with stage("harmonize", year=release.year, rows=len(df)):
+            counts, said = harmonize(counts, said, read_correspondence(release.correspondence))
+    table = compute_indicators(pd.DataFrame(counts, columns=compiled.columns), compiled)
+    table.index = pd.Index(said, name="SAID")
+    # indicators needing a column this release does not have
+    absent = ~np.array(present)
+    unavailable = ((compiled.numerator[absent] != 0) | (compiled.denominator[absent] != 0)).any(axis=0)
+    table.loc[:, unavailable] = np.nan
+    table.attrs["missing_columns"] = [c for c, p in zip(compiled.columns, present) if not p]
+    return table
+
+class CensusPanel:
+    """
+    Summary variables of several census releases, each loaded lazily when it is first queried.
+
+        panel = CensusPanel([CensusRelease(2011, "SAPS2011_SA.csv", columns={...}, correspondence="SA2011_SA2016.csv"),
+                             CensusRelease(2016, "SAPS2016_SA2017.csv")])
+        panel[2016]                          # summary variables of 2016
+        panel.wide(variables=["HE", "Owned"])  # all years side by side
+    """
+
+    def __init__(self, releases, cache=None):
+        self.releases = {r.year: r for r in releases}
+        self.cache = cache
+        self._tables = {}
+
+    @property
+    def years(self):
+        return sorted(self.releases)
+
+    @property
+    def loaded(self):
+        return sorted(self._tables)
+
+    def __getitem__(self, year):
+        if year not in self._tables:
+            release = self.releases[year]
+            if self.cache is None:
+                self.cache = StageCache()
+            files = [release.saps_path] + ([release.correspondence] if release.correspondence else [])
+            self._tables[year] = self.cache.run(
+                "panel", lambda: release_indicators(release), files=files,
+                params={"year": year, "columns": release.columns, "key": release.key,
+                        "indicators": hash_value(INDICATORS), "version": PANEL_VERSION}).value
+        return self._tables[year]
+
+    def missing(self, year):
+        """
+        SAPS columns (2016 codes) that release `year` does not have; the indicators using them are NaN
+        """
+        return self[year].attrs.get("missing_columns", [])
+
+    def wide(self, years=None, variables=None):
+        """
+        Data frame indexed by SAID with (year, variable) columns; small areas missing in a year get NaN
+        """
+        years = self.years if years is None else list(years)
+        variables = INDICATOR_NAMES if variables is None else list(variables)
+        return pd.concat({year: self[year][variables] for year in years}, axis=1, names=["year", "variable"])
+
+    def long(self, years=None, variables=None):
+        """
+        Data frame with one row per (SAID, year)
+        """
+        years = self.years if years is None else list(years)
+        variables = INDICATOR_NAMES if variables is None else list(variables)
+        return pd.concat([self[year][variables].assign(year=year) for year in years]).set_index("year", append=True)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+The stages of the two scripts ("Ireland 2015 Census Data.py" and "Clustering model.py") as cached functions:
+
+    indicators  SAPS csv + boundary key table   -> float32 summary variables of all small areas, with COUNTYNAME
+    region      indicators + counties            -> summary variables of the region (rows with invalid ratios dropped)
+    distances   region                           -> pairwise distance matrix (float32)
+    sweep       distances (or region)            -> labels, medoids and sum of distance for each k of the elbow sweep
+    final       sweep                            -> labels and medoids of the chosen K
+    geometry    shape file + counties            -> boundaries of the small areas of the region
+
+Each stage goes through a stage_cache.StageCache, so rerunning after an edit only recomputes
+the stages whose inputs (files, parameters, indicator definitions or upstream stages) changed.
+"""
+
+import numpy as np
+import pandas as pd
+
+from census_clustering import distance_matrix, elbow_sweep, fit_kmedoids
+from census_geometry import read_region
+from census_indicators import INDICATORS, INDICATOR_NAMES, compute_indicators, load_saps
+from census_keys import SAKeys, left_join, normalize_said
+from stage_cache import hash_value
+
+# version of the computation of each stage, part of its cache key: bump it whenever a stage's compute() changes
+# what it returns, so artifacts of the older code are not reused
+VERSIONS = {"indicators": 1, "region": 1, "distances": 1, "sweep": 1, "final": 1, "geometry": 2}
+
+def indicators(cache, saps_path, refkey_path):
+    def compute():
+        df = load_saps(saps_path)
+        census_final = compute_indicators(df, dtype=np.float32)
+        census_final["SAID"] = normalize_said(df["GEOGID"])
+        refkey = pd.read_csv(refkey_path, usecols=["COUNTYNAME", "SMALL_AREA"], dtype=str)[["COUNTYNAME", "SMALL_AREA"]]
+        keys = SAKeys(refkey["SMALL_AREA"])
+        keys.add_table("refkey", refkey["SMALL_AREA"])
+        return left_join(census_final, refkey, keys.rows("refkey", census_final["SAID"]))
+    return cache.run("indicators", compute, files=[saps_path, refkey_path],
+                     params={"indicators": hash_value(INDICATORS), "dtype": "float32",
+                             "version": VERSIONS["indicators"]})
+
+def region(cache, ireland, counties):
+    def compute():
+        table = ireland.value
+        # one mask and one copy; unlike dropna this also drops the inf ratios of zero denominators
+        keep = (table["COUNTYNAME"].isin(counties).to_numpy() & table["SAID"].notna().to_numpy()
+                & np.isfinite(table[INDICATOR_NAMES].to_numpy()).all(axis=1))
+        return table[keep]
+    return cache.run("region", compute, params={"counties": sorted(counties), "version": VERSIONS["region"]},
+                     upstream=[ireland])
+
+def distances(cache, census):
+    return cache.run("distances", lambda: distance_matrix(census.value[INDICATOR_NAMES]),
+                     params={"version": VERSIONS["distances"]}, upstream=[census])
+
+def _seed(random_state):
+    # random_state as an int for the npz artifacts (an object array of None could not be reloaded): -1 for None
+    return -1 if random_state is None else int(random_state)
+
+def _models_to_arrays(models, random_state, engine):
+    ks = sorted(models)
+    medoids = np.full((len(ks), max(ks)), -1, dtype=np.int64)
+    for i, k in enumerate(ks):
+        medoids[i, :k] = models[k].medoid_indices_
+    return {"ks": np.array(ks), "inertia": np.array([models[k].inertia_ for k in ks]),
+            "labels": np.stack([models[k].labels_ for k in ks]).astype(np.int16), "medoids": medoids,
+            "random_state": np.array(_seed(random_state)), "engine": np.array(engine)}
+
+def sweep(cache, data, ks=range(1, 21), random_state=10, engine="precomputed", n_jobs=-1):
+    """
+    `data` is the distances artifact for engine="precomputed", otherwise the region artifact
+    """
+    def compute():
+        X = data.value if engine == "precomputed" else data.value[INDICATOR_NAMES]
+        return _models_to_arrays(elbow_sweep(X, ks, random_state, engine, n_jobs), random_state, engine)
+    return cache.run("sweep", compute, params={"ks": list(ks), "random_state": random_state, "engine": engine,
+                                               "version": VERSIONS["sweep"]},
+                     upstream=[data])
+
+def final(cache, data, sweep_result, k=8, random_state=10, engine="precomputed"):
+    """
+    Labels (1, ..., k, as in the cluster1 column) and medoids of the final model; taken from the sweep
+    when it contains k for the same random_state and engine, otherwise fitted on `data`
+    (the distances artifact for engine="precomputed", otherwise the region artifact).
+    """
+    def compute():
+        fitted = sweep_result.value
+        if k in fitted["ks"] and int(fitted["random_state"]) == _seed(random_state) and str(fitted["engine"]) == engine:
+            i = int(np.flatnonzero(fitted["ks"] == k)[0])
+            return {"cluster1": fitted["labels"][i].astype(np.int64) + 1, "medoids": fitted["medoids"][i, :k],
+                    "inertia": fitted["inertia"][i:i + 1]}
+        X = data.value if engine == "precomputed" else data.value[INDICATOR_NAMES]
+        model = fit_kmedoids(X, k, random_state, engine)
+        return {"cluster1": model.labels_ + 1, "medoids": np.asarray(model.medoid_indices_),
+                "inertia": np.array([model.inertia_])}
+    return cache.run("final", compute, params={"k": k, "random_state": random_state, "engine": engine,
+                                               "version": VERSIONS["final"]},
+                     upstream=[data, sweep_result])
+
+def geometry(cache, shapefile, counties):
+    return cache.run("geometry", lambda: read_region(shapefile, where={"COUNTYNAME": list(counties)}),
+                     files=[shapefile + ext for ext in (".shp", ".shx", ".dbf")],
+                     params={"counties": sorted(counties), "version": VERSIONS["geometry"]})
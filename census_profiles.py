@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of the census clusters, as in the paper:
+    Hu et al (2020), "A spatial machine learning model for analyzing customers' lapse behaviour in life insurance", Annals of Actuarial Science.
+
+cluster_profiles() computes, for all summary variables at once, the per-cluster size, mean, standard deviation,
+quartiles, boxplot whiskers (most extreme values within 1.5 IQR of the quartiles) and the standardized difference
+of the cluster mean from the overall mean. The rows are sorted by cluster once and each cluster is summarised
+for all variables together. The data can be float32 (e.g. a census_store.IndicatorStore frame) and rows can be
+selected by a mask, so the sorted copy is the only copy made; NaN values are left out of the statistics.
+plot_profiles() then draws the boxplots from this compact table, without the raw data
+(so outliers beyond the whiskers are not drawn).
+"""
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+STATS = ["n", "mean", "sd", "q1", "median", "q3", "whislo", "whishi", "std_diff"]
+
+def cluster_profiles(data, clusters, variables=None, rows=None):
+    """
+    Summary statistics of each variable in each cluster.
+
+    `data` is a data frame of the summary variables, `clusters` the cluster of each row (e.g. census["cluster1"]),
+    `rows` an optional boolean mask of the rows to profile (e.g. IndicatorStore.complete()).
+    Returns a data frame indexed by (variable, cluster) with the columns in STATS.
+    """
+    if variables is None:
+        variables = [c for c in data.columns if pd.api.types.is_numeric_dtype(data[c])]
+    # all columns of a single-dtype frame are a view of its array, a column selection is a copy
+    X = (data if list(variables) == list(data.columns) else data[list(variables)]).to_numpy()
+    if not np.issubdtype(X.dtype, np.floating):
+        X = X.astype(np.float64)
+    clusters = np.asarray(clusters)
+    selected = np.arange(len(X)) if rows is None else np.flatnonzero(rows)
+    order = selected[np.argsort(clusters[selected], kind="stable")]
+    X, labels = X[order], clusters[order]
+    values, starts = np.unique(labels, return_index=True)
+    stops = np.append(starts[1:], len(labels))
+
+    overall_mean = np.nanmean(X, axis=0, dtype=np.float64)
+    overall_sd = np.nanstd(X, axis=0, ddof=1, dtype=np.float64)
+
+    blocks = []
+    for value, start, stop in zip(values, starts, stops):
+        block = X[start:stop]
+        q1, median, q3 = np.nanpercentile(block, [25, 50, 75], axis=0)
+        iqr = q3 - q1
+        low = np.where(block >= q1 - 1.5 * iqr, block, np.inf).min(axis=0)
+        high = np.where(block <= q3 + 1.5 * iqr, block, -np.inf).max(axis=0)
+        mean = np.nanmean(block, axis=0, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std_diff = (mean - overall_mean) / overall_sd
+        sd = np.nanstd(block, axis=0, ddof=1, dtype=np.float64) if stop - start > 1 else np.full(len(variables), np.nan)
+        blocks.append(pd.DataFrame({"variable": variables, "cluster": value, "n": np.sum(~np.isnan(block), axis=0),
+                                    "mean": mean, "sd": sd, "q1": q1, "median": median, "q3": q3,
+                                    "whislo": low, "whishi": high, "std_diff": std_diff}))
+    profiles = pd.concat(blocks, ignore_index=True)
+    profiles["variable"] = pd.Categorical(profiles["variable"], categories=list(variables))
+    return profiles.sort_values(["variable", "cluster"]).set_index(["variable", "cluster"])
+
+def plot_profiles(profiles, variables=None, ylabels=None, palette=None, figsize=(6, 4)):
+    """
+    One boxplot per variable, of the variable in each cluster, drawn from the output of cluster_profiles().
+
+    `ylabels` maps variables to axis labels, `palette` maps clusters to colours.
+    Returns the list of axes.
+    """
+    if variables is None:
+        variables = list(profiles.index.get_level_values("variable").unique())
+    ylabels = ylabels or {}
+    axes = []
+    for variable in variables:
+        table = profiles.xs(variable, level="variable")
+        stats = [{"label": str(cluster), "med": row["median"], "q1": row["q1"], "q3": row["q3"],
+                  "whislo": row["whislo"], "whishi": row["whishi"], "mean": row["mean"]}
+                 for cluster, row in table.iterrows()]
+        fig, ax = plt.subplots(figsize=figsize)
+        boxes = ax.bxp(stats, showfliers=False, patch_artist=True, medianprops={"color": "0.25"})
+        if palette is not None:
+            for patch, cluster in zip(boxes["boxes"], table.index):
+                patch.set_facecolor(palette[cluster])
+        ax.set(xlabel="Cluster", ylabel=ylabels.get(variable, variable))
+        axes.append(ax)
+    return axes
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Levels of detail of the small area boundaries, for drawing maps at any scale.
+
+simplify() splits the rings of a census_geometry.Geometry into arcs at the junctions (vertices where three or more
+borders meet, i.e. with other than two distinct neighbours), simplifies every distinct arc once with the
+Douglas-Peucker algorithm, and reassembles the rings from the simplified arcs. A border shared by two small areas
+is one arc, so it is simplified the same way in both (no slivers or gaps are drawn between neighbours), and
+the junctions are kept, so small areas sharing an edge or a vertex still do. Only original vertices are kept.
+Rings made of one or two arcs keep enough vertices to enclose an area. A part that still collapses (zero area, or
+turned inside out) is dropped, unless it is the last part of its shape: such shapes keep their original parts.
+Everything is vectorized over the vertex arrays.
+
+The simplified borders can still cross other borders at coarse tolerances; compute point-in-polygon lookups
+on the original geometry.
+
+levels_of_detail() precomputes the levels for a series of tolerances (doubling from about the typical edge length)
+and caches them next to the geometry arrays (for a geometry loaded with read_geometry) or in memory.
+choose_level() picks the coarsest level that moves no border by more than one pixel of a map with the given extent
+and size;
+census_maps.py uses it to draw overview maps with far fewer vertices than zoomed views.
+"""
+
+import json
+import os
+import weakref
+
+import numpy as np
+
+from census_files import replace_directory
+from census_geometry import Geometry, _ranges
+from census_trace import stage
+
+# format of the cached levels, bumped whenever simplify() changes so older caches are rebuilt
+LEVEL_VERSION = 3
+
+# levels already loaded or computed, per geometry object
+_memory = weakref.WeakKeyDictionary()
+
+def simplify(geometry, tolerance, decimals=9):
+    """
+    New Geometry with the borders simplified so that no removed vertex lies further than `tolerance`
+    (in coordinate units) from the simplified border. Shapes keep their positions, bounding boxes and records,
+    and a shape with parts keeps at least one. Vertices equal to `decimals` decimals are the same vertex.
+    """
+    vertices = np.asarray(geometry.vertices, dtype=np.float64)
+    part_offsets = np.asarray(geometry.part_offsets)
+    n_parts = len(part_offsets) - 1
+    part = np.repeat(np.arange(n_parts), np.diff(part_offsets))
+    origin = vertices.min(axis=0) if len(vertices) else np.zeros(2)
+    areas = _signed_areas(vertices - origin, part, n_parts)
+
+    # vertex ids, equal for vertices that are equal to `decimals` decimals (as in census_spatial.contiguity)
+    q = np.round(vertices * 10.0 ** decimals).astype(np.int64)
+    order = np.lexsort((q[:, 1], q[:, 0]))
+    new = np.ones(len(q), dtype=bool)
+    new[1:] = (q[order[1:]] != q[order[:-1]]).any(axis=1)
+    ids = np.empty(len(q), dtype=np.int64)
+    ids[order] = np.cumsum(new) - 1
+    n_ids = ids.max() + 1 if len(ids) else 0
+
+    # repeated vertices
+    keep = np.ones(len(vertices), dtype=bool)
+    keep[1:] = (ids[1:] != ids[:-1]) | (part[1:] != part[:-1])
+    xy, ids, part = vertices[keep], ids[keep], part[keep]
+    counts = np.bincount(part, minlength=n_parts)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    pos = _ranges(np.zeros(n_parts, dtype=np.int64), counts)
+
+    # number of distinct neighbours of each vertex along all borders: junctions have other than 2
+    same_part = part[1:] == part[:-1]
+    a, b = ids[:-1][same_part], ids[1:][same_part]
+    edges = np.unique(np.minimum(a, b) * n_ids + np.maximum(a, b))
+    junction = np.bincount(np.concatenate([edges // n_ids, edges % n_ids]), minlength=n_ids) != 2
+
+    # start each closed ring at its first junction (at its lowest vertex id if it has none), so the rings of
+    # two small areas sharing a border cut it at the same vertices
+    last = offsets[1:] - 1
+    closed = (counts > 1) & (ids[np.maximum(last, 0)] == ids[np.minimum(offsets[:-1], len(ids) - 1)])
+    length = np.where(closed, counts - 1, counts)
+    rank = np.where(pos >= np.repeat(length, counts), 2, np.where(junction[ids], 0, 1))
+    order = np.lexsort((np.where(junction[ids], pos, ids), rank, part))
+    start = np.zeros(n_parts, dtype=np.int64)
+    start[counts > 0] = pos[order[offsets[:-1][counts > 0]]]
+    start[~closed] = 0
+    period = np.repeat(np.maximum(length, 1), counts)
+    rotated = np.repeat(offsets[:-1], counts) + (np.repeat(start, counts) + pos) % period
+    xy, ids = xy[rotated], ids[rotated]
+
+    # arcs: the stretches of ring between two cuts (junctions, and the ends of each ring)
+    cut = np.flatnonzero(junction[ids] | (pos == 0) | (pos == np.repeat(counts, counts) - 1))
+    pair = part[cut[1:]] == part[cut[:-1]]
+    lo, hi = cut[:-1][pair], cut[1:][pair]
+    # orientation of each arc shared by the rings on both sides (a reversed arc runs backwards in its ring),
+    # and the arc's first two vertices in that orientation, which identify it
+    s, e = ids[lo], ids[hi]
+    reverse = (e < s) | ((e == s) & (ids[hi - 1] < ids[lo + 1]))
+    first = np.where(reverse, e, s) * n_ids + np.where(reverse, ids[hi - 1], ids[lo + 1])
+    _, arc_index, arc = np.unique(first, return_index=True, return_inverse=True)
+    arc = arc.ravel()
+
+    # simplify every distinct arc once
+    arc_lo, arc_hi, arc_reverse = lo[arc_index], hi[arc_index], reverse[arc_index]
+    arc_counts = arc_hi - arc_lo + 1
+    step = _ranges(np.zeros(len(arc_index), dtype=np.int64), arc_counts)
+    points = xy[np.where(np.repeat(arc_reverse, arc_counts), np.repeat(arc_hi, arc_counts) - step,
+                         np.repeat(arc_lo, arc_counts) + step)]
+    arc_offsets = np.concatenate([[0], np.cumsum(arc_counts)])
+    # closed arcs keep two interior vertices, and arcs between the same two junctions one, so rings of one or
+    # two arcs keep an area
+    ends = np.minimum(s, e)[arc_index] * n_ids + np.maximum(s, e)[arc_index]
+    _, ends_index, ends_count = np.unique(ends, return_inverse=True, return_counts=True)
+    force = np.where(s[arc_index] == e[arc_index], 2, (ends_count[ends_index.ravel()] > 1).astype(np.int64))
+    kept = _douglas_peucker(points, arc_offsets, tolerance, force)
+
+    # reassemble the rings from their simplified arcs, each arc after the first without its first vertex
+    kept_counts = np.add.reduceat(kept, arc_offsets[:-1]) if len(arc_index) else np.zeros(0, dtype=np.int64)
+    kept_offsets = np.concatenate([[0], np.cumsum(kept_counts)])
+    kept_points = points[kept]
+    skip = (lo != offsets[part[lo]]).astype(np.int64)
+    n = kept_counts[arc] - skip
+    step = _ranges(skip, n)
+    index = np.where(np.repeat(reverse, n), np.repeat(kept_offsets[arc + 1] - 1, n) - step,
+                     np.repeat(kept_offsets[arc], n) + step)
+    xy, part = kept_points[index], np.repeat(part[lo], n)
+
+    # parts with fewer than 4 vertices (3 distinct plus the closing one) and parts whose area collapsed
+    # to zero or changed sign (turned inside out) are dropped, unless their shape would lose all its parts:
+    # those shapes keep their original parts
+    counts = np.bincount(part, minlength=n_parts)
+    simplified = _signed_areas(xy - origin, part, n_parts)
+    alive = (counts >= 4) & (np.sign(simplified) == np.sign(areas)) & (simplified != 0)
+    shape_offsets = np.asarray(geometry.shape_offsets)
+    n_shape_parts = np.diff(shape_offsets)
+    alive_parts = np.bincount(np.repeat(np.arange(len(n_shape_parts)), n_shape_parts), weights=alive,
+                              minlength=len(n_shape_parts))
+    restore = np.repeat((alive_parts == 0) & (n_shape_parts > 0), n_shape_parts) & ~alive
+    starts = np.where(restore, len(xy) + part_offsets[:-1], np.concatenate([[0], np.cumsum(counts)])[:-1])
+    counts = np.where(restore, np.diff(part_offsets), counts)
+    used = alive | restore
+    xy = np.concatenate([xy, vertices])[_ranges(starts[used], counts[used])]
+    part_offsets = np.concatenate([[0], np.cumsum(counts[used])])
+    shape_offsets = np.concatenate([[0], np.cumsum(used)])[shape_offsets]
+    return Geometry(xy, part_offsets, shape_offsets, geometry.bbox, geometry.records)
+
+def _douglas_peucker(points, offsets, tolerance, force):
+    # mask of the vertices kept by the Douglas-Peucker algorithm on each line points[offsets[i]:offsets[i + 1]],
+    # vectorized over all the stretches split in the same round; force[i] rounds of splits are made on line i
+    # whatever the tolerance
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets[:-1]] = keep[offsets[1:] - 1] = True
+    lo, hi = offsets[:-1], offsets[1:] - 1
+    while True:
+        inner = hi - lo - 1
+        lo, hi, force, inner = lo[inner > 0], hi[inner > 0], force[inner > 0], inner[inner > 0]
+        if not len(lo):
+            return keep
+        index = _ranges(lo + 1, inner)
+        a, b = np.repeat(points[lo], inner, axis=0), np.repeat(points[hi], inner, axis=0)
+        # distance to the segment a-b (to the point a for closed stretches)
+        ab, ap = b - a, points[index] - a
+        norm = (ab ** 2).sum(axis=1)
+        t = np.clip((ap * ab).sum(axis=1) / np.where(norm > 0, norm, 1.0), 0.0, 1.0)
+        d = np.hypot(*(ap - t[:, None] * ab).T)
+        first = np.concatenate([[0], np.cumsum(inner)[:-1]])
+        far = np.maximum.reduceat(d, first)
+        at = np.minimum.reduceat(np.where(d == np.repeat(far, inner), np.arange(len(d)), len(d)), first)
+        split = (far > tolerance) | (force > 0)
+        middle = index[at[split]]
+        keep[middle] = True
+        lo, hi = np.concatenate([lo[split], middle]), np.concatenate([middle, hi[split]])
+        force = np.tile(force[split] - 1, 2)
+
+def _signed_areas(xy, part, n_parts):
+    # twice the signed area of each closed part (shoelace formula), 0 for parts without vertices
+    same = part[1:] == part[:-1]
+    cross = xy[:-1, 0] * xy[1:, 1] - xy[1:, 0] * xy[:-1, 1]
+    return np.bincount(part[:-1][same], weights=cross[same], minlength=n_parts)
+
+def default_tolerances(geometry, n_levels=6):
+    """
+    Tolerances doubling from twice the median edge length of the geometry
+    """
+    vertices = np.asarray(geometry.vertices)
+    step = np.hypot(*np.diff(vertices[:min(len(vertices), 100000)], axis=0).T)
+    base = np.median(step[step > 0]) if np.any(step > 0) else 1.0
+    return [float("%.3g" % (base * 2 ** (i + 1))) for i in range(n_levels)]
+
+def _level_directory(geometry, tolerance):
+    return os.path.join(geometry.directory, "lod", "%.6g" % tolerance)
+
+def _load_level(geometry, tolerance):
+    directory = _level_directory(geometry, tolerance)
+    meta_path = os.path.join(directory, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        if json.load(f) != {"source": geometry.meta, "tolerance": tolerance, "version": LEVEL_VERSION}:
+            return None
+    arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+              for name in ["vertices", "part_offsets", "shape_offsets"]]
+    return Geometry(*arrays, geometry.bbox, geometry.records)
+
+def _save_level(geometry, tolerance, level):
+    def write(directory):
+        for name in ["vertices", "part_offsets", "shape_offsets"]:
+            np.save(os.path.join(directory, name + ".npy"), getattr(level, name))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"source": geometry.meta, "tolerance": tolerance, "version": LEVEL_VERSION}, f)
+    replace_directory(_level_directory(geometry, tolerance), write)
+
+def levels_of_detail(geometry, tolerances=None, cache=True):
+    """
+    [(tolerance, simplified Geometry)] from the finest to the coarsest level.
+
+    For a geometry loaded with read_geometry, the levels are cached in its cache folder and memory-mapped on later
+    loads (rebuilt whenever the shape files change); for other geometries they are kept in memory.
+    """
+    if tolerances is None:
+        tolerances = default_tolerances(geometry)
+    on_disk = cache and getattr(geometry, "directory", None) is not None
+    memory = _memory.setdefault(geometry, {}) if cache else {}
+    levels = []
+    for tolerance in sorted(tolerances):
+        level = memory.get(tolerance)
+        if level is None and on_disk:
+            level = _load_level(geometry, tolerance)
+        if level is None:
+            with stage("simplify", tolerance=tolerance, vertices=len(geometry.vertices)):
+                level = simplify(geometry, tolerance)
+            if on_disk:
+                _save_level(geometry, tolerance, level)
+        memory[tolerance] = level
+        levels.append((tolerance, level))
+    return levels
+
+def choose_level(geometry, extent, size, dpi=100, levels=None):
+    """
+    The coarsest level of detail of `geometry` that moves no border by more than one pixel, when
+    `extent` = (xmin, ymin, xmax, ymax) is drawn on axes of `size` = (width, height) inches;
+    the geometry itself if no level is fine enough.
+    """
+    if levels is None:
+        levels = levels_of_detail(geometry)
+    pixel = min((extent[2] - extent[0]) / (size[0] * dpi), (extent[3] - extent[1]) / (size[1] * dpi))
+    chosen = geometry
+    for tolerance, level in levels:
+        # removed vertices are at most `tolerance` from the simplified border
+        if tolerance <= pixel:
+            chosen = level
+    return chosen
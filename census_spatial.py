@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial queries on the small area boundaries of a census_geometry.Geometry.
+
+SpatialIndex maps (lon, lat) points, e.g. geocoded policyholder addresses, to the small area containing them.
+The bounding boxes of the small areas are registered in a uniform grid, so each point is only tested
+against the few small areas whose box covers its grid cell. The point-in-polygon test (even-odd ray casting,
+so holes are handled) is vectorized over all (point, candidate edge) pairs of a chunk of points,
+and chunks can be processed in parallel.
+
+contiguity() builds the Queen or Rook neighbour graph of the small areas as a sparse matrix.
+"""
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from joblib import Parallel, delayed
+
+from census_geometry import _ranges
+
+def _edges(geometry):
+    # first vertex of every boundary edge, and the range of each shape's edges in that array
+    valid = np.ones(len(geometry.vertices), dtype=bool)
+    valid[np.asarray(geometry.part_offsets[1:]) - 1] = False  # the last vertex of a part starts no edge
+    edge_start = np.flatnonzero(valid)
+    shape_vertex = np.asarray(geometry.part_offsets)[np.asarray(geometry.shape_offsets)]
+    edge_offsets = np.searchsorted(edge_start, shape_vertex)
+    return edge_start, edge_offsets
+
+class SpatialIndex:
+    """
+    Uniform grid index over the bounding boxes of the shapes of a Geometry.
+
+    cells_per_shape sets the number of grid cells relative to the number of shapes.
+    """
+
+    def __init__(self, geometry, cells_per_shape=1.0):
+        self.geometry = geometry
+        self.vertices = np.asarray(geometry.vertices)
+        self.bbox = np.asarray(geometry.bbox)
+        self.edge_start, self.edge_offsets = _edges(geometry)
+
+        shapes = np.flatnonzero(np.isfinite(self.bbox).all(axis=1))
+        box = self.bbox[shapes]
+        self.origin = np.array([box[:, 0].min(), box[:, 1].min()]) if len(shapes) else np.zeros(2)
+        width = max(box[:, 2].max() - self.origin[0], 1e-12) if len(shapes) else 1.0
+        height = max(box[:, 3].max() - self.origin[1], 1e-12) if len(shapes) else 1.0
+        n_cells = max(cells_per_shape * len(shapes), 1)
+        self.nx = max(int(np.ceil(np.sqrt(n_cells * width / height))), 1)
+        self.ny = max(int(np.ceil(n_cells / self.nx)), 1)
+        self.cell_size = np.array([width / self.nx, height / self.ny])
+
+        # register every shape in all the cells its bounding box covers
+        ix0, iy0 = self._cell(box[:, 0], box[:, 1])
+        ix1, iy1 = self._cell(box[:, 2], box[:, 3])
+        wx, wy = ix1 - ix0 + 1, iy1 - iy0 + 1
+        counts = wx * wy
+        owner = np.repeat(np.arange(len(shapes)), counts)
+        local = _ranges(np.zeros(len(shapes), dtype=np.int64), counts)
+        cell = (iy0[owner] + local // wx[owner]) * self.nx + ix0[owner] + local % wx[owner]
+        order = np.argsort(cell, kind="stable")
+        self.cell_shapes = shapes[owner[order]]
+        self.cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.nx * self.ny))])
+
+    def __len__(self):
+        return len(self.bbox)
+
+    def _cell(self, x, y):
+        ix = np.clip(np.floor((x - self.origin[0]) / self.cell_size[0]).astype(np.int64), 0, self.nx - 1)
+        iy = np.clip(np.floor((y - self.origin[1]) / self.cell_size[1]).astype(np.int64), 0, self.ny - 1)
+        return ix, iy
+
+    def locate(self, x, y, chunk_size=20000, n_jobs=1):
+        """
+        Position (in the geometry) of the shape containing each point (x[i], y[i]), -1 if none.
+
+        Points are processed in chunks of `chunk_size`; n_jobs > 1 (or -1 for all cores) processes chunks in parallel.
+        If shapes overlap, the first one is returned.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        chunks = [slice(start, start + chunk_size) for start in range(0, len(x), chunk_size)]
+        if n_jobs == 1:
+            parts = [self._locate_chunk(x[c], y[c]) for c in chunks]
+        else:
+            parts = Parallel(n_jobs=n_jobs)(delayed(_locate_chunk)(self, x[c], y[c]) for c in chunks)
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def small_areas(self, x, y, column="SMALL_AREA", **kwargs):
+        """
+        Value of `column` of the records (e.g. the SMALL_AREA ID) of the shape containing each point, None if none
+        """
+        found = self.locate(x, y, **kwargs)
+        values = self.geometry.records[column].to_numpy().astype(object)
+        return np.where(found >= 0, values[np.maximum(found, 0)], None)
+
+    def _locate_chunk(self, x, y):
+        m = len(x)
+        result = np.full(m, -1, dtype=np.int64)
+        if m == 0 or len(self.cell_shapes) == 0:
+            return result
+        inside_grid = ((x >= self.origin[0]) & (x <= self.origin[0] + self.nx * self.cell_size[0]) &
+                       (y >= self.origin[1]) & (y <= self.origin[1] + self.ny * self.cell_size[1]))
+        ix, iy = self._cell(x, y)
+        cell = iy * self.nx + ix
+        start = self.cell_offsets[cell]
+        n_candidates = np.where(inside_grid, self.cell_offsets[cell + 1] - start, 0)
+
+        # (point, shape) candidate pairs whose bounding box contains the point
+        point = np.repeat(np.arange(m), n_candidates)
+        shape = self.cell_shapes[_ranges(start[n_candidates > 0], n_candidates[n_candidates > 0])]
+        box = self.bbox[shape]
+        px, py = x[point], y[point]
+        keep = (px >= box[:, 0]) & (px <= box[:, 2]) & (py >= box[:, 1]) & (py <= box[:, 3])
+        point, shape, px, py = point[keep], shape[keep], px[keep], py[keep]
+
+        # even-odd ray casting over every edge of every candidate shape
+        first = self.edge_offsets[shape]
+        n_edges = self.edge_offsets[shape + 1] - first
+        pair = np.repeat(np.arange(len(point)), n_edges)
+        j = self.edge_start[_ranges(first, n_edges)]
+        x1, y1 = self.vertices[j, 0], self.vertices[j, 1]
+        x2, y2 = self.vertices[j + 1, 0], self.vertices[j + 1, 1]
+        qx, qy = px[pair], py[pair]
+        straddles = (y1 > qy) != (y2 > qy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing = straddles & (qx < (x2 - x1) * (qy - y1) / (y2 - y1) + x1)
+        inside = np.bincount(pair, crossing, minlength=len(point)) % 2 == 1
+
+        found = np.full(m, np.iinfo(np.int64).max)
+        np.minimum.at(found, point[inside], shape[inside])
+        result[found != np.iinfo(np.int64).max] = found[found != np.iinfo(np.int64).max]
+        return result
+
+def _locate_chunk(index, x, y):
+    return index._locate_chunk(x, y)
+
+
+#%%
+"""
+Contiguity (neighbour) graphs
+
+Two small areas are Queen neighbours if their boundaries share at least one vertex,
+and Rook neighbours if they share at least one edge. Instead of testing every pair of polygons,
+vertices (rounded to `decimals` decimal places) and edges are given integer keys, 
+and the shapes x keys incidence matrix I gives all neighbours at once as I @ I.T. 
+"""
+
+def _keys(rows):
+    # integer key of each distinct row of a 2-column integer array
+    _, keys = np.unique(rows, axis=0, return_inverse=True)
+    return keys.ravel()
+
+def _shared(owner, keys, n):
+    # shapes x shapes matrix of the number of keys two shapes share, without the diagonal
+    n_keys = keys.max() + 1 if len(keys) else 0
+    incidence = sp.csr_matrix((np.ones(len(keys), dtype=np.int32), (owner, keys)), shape=(n, n_keys))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1  # a key repeated within a shape (e.g. closing vertices) counts once
+    shared = (incidence @ incidence.T).tocsr()
+    shared.setdiag(0)
+    shared.eliminate_zeros()
+    return shared
+
+def contiguity(geometry, kind="queen", decimals=9, cache=True):
+    """
+    Queen (kind="queen") or Rook (kind="rook") contiguity of the shapes of a Geometry,
+    as a binary (n_shapes, n_shapes) scipy.sparse CSR matrix.
+
+    If the geometry was loaded from the read_geometry cache, the matrix is cached in the same folder
+    and reused as long as the shape files are unchanged.
+    """
+    if kind not in ("queen", "rook"):
+        raise ValueError("kind=%s is not supported, use 'queen' or 'rook'" % kind)
+    path = None
+    if cache and getattr(geometry, "directory", None) is not None:
+        path = os.path.join(geometry.directory, "%s_%d.npz" % (kind, decimals))
+        stamp = json.dumps(geometry.meta, sort_keys=True)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                if str(cached["meta"]) == stamp:
+                    return sp.csr_matrix((cached["data"], cached["indices"], cached["indptr"]), shape=tuple(cached["shape"]))
+
+    n = len(geometry)
+    vertices = np.round(np.asarray(geometry.vertices) * 10.0 ** decimals).astype(np.int64)
+    counts = np.diff(np.asarray(geometry.part_offsets)[np.asarray(geometry.shape_offsets)])
+    owner = np.repeat(np.arange(n), counts)
+    vertex_key = _keys(vertices)
+    if kind == "queen":
+        shared = _shared(owner, vertex_key, n)
+    else:
+        edge_start, _ = _edges(geometry)
+        a, b = vertex_key[edge_start], vertex_key[edge_start + 1]
+        edge = np.stack([np.minimum(a, b), np.maximum(a, b)], axis=1)
+        real = a != b  # repeated vertices make no edge
+        shared = _shared(owner[edge_start][real], _keys(edge[real]), n)
+    graph = sp.csr_matrix((np.ones(shared.nnz, dtype=np.int8), shared.indices, shared.indptr), shape=(n, n))
+
+    if path is not None:
+        np.savez(path, data=graph.data, indices=graph.indices, indptr=graph.indptr, shape=graph.shape, meta=stamp)
+    return graph
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage of the summary census variables, for clustering and profiling.
+
+The 69 summary variables of all small areas are kept in one contiguous (n_areas, n_variables) float32 array
+(half the memory of float64 columns, and the precision of the census ratios is far below float32's),
+with a packed bitmask of the valid (finite) values: one bit per value, one row of bytes per small area.
+Ratios with a zero denominator (inf, or NaN for 0/0) are set to NaN in the array and counted per variable,
+so report() shows which variables are affected and how often, instead of them being silently kept or dropped.
+
+Rows are selected with boolean masks (complete() gives the small areas with every variable valid), and frame()
+returns a data frame over the array itself rather than a copy whenever every selected row is complete.
+The other columns (SAID, COUNTYNAME, SMALL_AREA, ...) are kept in a separate records data frame.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from census_files import replace_directory
+from census_indicators import INDICATOR_NAMES
+
+class IndicatorStore:
+    """
+    values   : (n_areas, n_variables) C-contiguous float32 summary variables, NaN where not valid
+    valid    : (n_areas, ceil(n_variables / 8)) uint8 bitmask of the valid values (np.packbits of each row)
+    names    : names of the variables, in the order of the columns of values
+    records  : data frame of the other columns, with one row per small area
+    n_inf    : (n_variables,) number of infinite ratios (zero denominator) of each variable
+    n_nan    : (n_variables,) number of undefined (0/0) or missing values of each variable
+    """
+
+    def __init__(self, values, valid, names, records, n_inf, n_nan):
+        self.values = values
+        self.valid = valid
+        self.names = list(names)
+        self.records = records
+        self.n_inf = np.asarray(n_inf)
+        self.n_nan = np.asarray(n_nan)
+
+    @classmethod
+    def from_frame(cls, df, names=INDICATOR_NAMES):
+        """
+        Store of the columns `names` of the data frame `df` (e.g. census_final); the other columns are the records
+        """
+        values = np.ascontiguousarray(df[list(names)].to_numpy(dtype=np.float32))
+        infinite = np.isinf(values)
+        finite = np.isfinite(values)
+        n_inf = infinite.sum(axis=0)
+        n_nan = len(values) - finite.sum(axis=0) - n_inf
+        values[~finite] = np.nan
+        records = df[[c for c in df.columns if c not in set(names)]]
+        return cls(values, np.packbits(finite, axis=1), names, records, n_inf, n_nan)
+
+    @classmethod
+    def read_csv(cls, path, names=INDICATOR_NAMES, index_col=0, **kwargs):
+        """
+        Store of a csv written by the extraction script (e.g. NewCensusData_final_Dublin.csv);
+        the variables are parsed straight to float32
+        """
+        df = pd.read_csv(path, index_col=index_col, dtype=dict({n: np.float32 for n in names}, SAID=str), **kwargs)
+        return cls.from_frame(df, names)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def validity(self, variables=None):
+        """
+        (n_areas, n_variables) boolean array of the valid values (of `variables` only, if given)
+        """
+        valid = np.unpackbits(self.valid, axis=1, count=len(self.names)).view(bool)
+        return valid if variables is None else valid[:, self._columns(variables)]
+
+    def complete(self, variables=None):
+        """
+        Boolean mask of the small areas whose variables (or `variables` only) are all valid
+        """
+        if variables is None:
+            full = np.packbits(np.ones(len(self.names), dtype=bool))
+            return (self.valid == full).all(axis=1)
+        return self.validity(variables).all(axis=1)
+
+    def report(self):
+        """
+        Data frame of the number and ratio of invalid values of each variable with any,
+        split into infinite (zero denominator) and undefined (0/0 or missing) values
+        """
+        table = pd.DataFrame({"inf": self.n_inf, "nan": self.n_nan}, index=pd.Index(self.names, name="variable"))
+        table["invalid"] = table["inf"] + table["nan"]
+        table["invalid_ratio"] = table["invalid"] / max(len(self), 1)
+        return table[table["invalid"] > 0]
+
+    def frame(self, rows=None, variables=None):
+        """
+        Data frame of the variables of the selected rows (boolean mask, positions or slice), indexed like the records.
+        Without `variables`, a view of the array when all rows are selected (e.g. a complete() mask
+        of a store without invalid values); otherwise the selected rows are copied once.
+        """
+        if rows is not None and np.asarray(rows).dtype == bool and np.all(rows):
+            rows = None
+        values = self.values if rows is None else self.values[rows]
+        index = self.records.index if rows is None else self.records.index[rows]
+        if variables is not None:
+            values = values[:, self._columns(variables)]
+        names = self.names if variables is None else list(variables)
+        return pd.DataFrame(values, columns=names, index=index, copy=False)
+
+    def _columns(self, variables):
+        position = {name: j for j, name in enumerate(self.names)}
+        missing = [v for v in variables if v not in position]
+        if missing:
+            raise ValueError("the store has no variables %s" % ", ".join(missing))
+        return np.array([position[v] for v in variables])
+
+    def save(self, directory):
+        """
+        Write the store to `directory`, replacing any store there in one step (see census_files.replace_directory)
+        """
+        replace_directory(directory, self._write)
+
+    def _write(self, directory):
+        np.save(os.path.join(directory, "values.npy"), self.values)
+        np.save(os.path.join(directory, "valid.npy"), self.valid)
+        self.records.to_pickle(os.path.join(directory, "records.pkl"))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"names": self.names, "n_inf": self.n_inf.tolist(), "n_nan": self.n_nan.tolist()}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mode = "r" if mmap else None
+        values = np.load(os.path.join(directory, "values.npy"), mmap_mode=mode)
+        valid = np.load(os.path.join(directory, "valid.npy"), mmap_mode=mode)
+        records = pd.read_pickle(os.path.join(directory, "records.pkl"))
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(values, valid, meta["names"], records, meta["n_inf"], meta["n_nan"])
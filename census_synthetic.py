@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic stand-ins for the CSO files, to test and benchmark the pipeline without the licensed data:
+
+    SAPS2016_SA2017.csv                     raw small area counts, with the SAPS column names used by the indicators
+    Small_Areas_Boundaries_2015.csv         boundary key table (COUNTY, COUNTYNAME, SMALL_AREA, GEOGID)
+    Census2016_Small_Areas_generalised20m   polygon shape file (.shp, .shx, .dbf, .cpg)
+
+Small areas are the cells of a jittered grid over Ireland, so neighbouring small areas share their borders
+vertex for vertex, and are grouped into the 31 local authorities in contiguous blocks.
+The counts of each SAPS table add up to its total column (the remainder is an unlisted "other" category),
+and are drawn from small area "types" that are spatially clustered, so the data has clusters to find.
+All files are written with vectorized numpy code, e.g.
+
+    python census_synthetic.py synthetic_200k --n-areas 200000
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from census_indicators import INDICATORS
+
+COUNTIES = ['Fingal', 'Dublin City', 'South Dublin', 'Dún Laoghaire-Rathdown', 'Kildare County', 'Meath County',
+            'Wicklow County', 'Louth County', 'Carlow County', 'Kilkenny County', 'Laois County', 'Longford County',
+            'Offaly County', 'Westmeath County', 'Wexford County', 'Clare County', 'Cork City', 'Cork County',
+            'Kerry County', 'Limerick City and County', 'Tipperary County', 'Waterford City and County',
+            'Galway City', 'Galway County', 'Leitrim County', 'Mayo County', 'Roscommon County', 'Sligo County',
+            'Cavan County', 'Donegal County', 'Monaghan County']
+
+# people (or households, families, ...) counted by each SAPS table, relative to the population
+_TABLE_SHARE = {"T1": 1.0, "T2": 1.0, "T4": 0.28, "T5": 0.36, "T6": 0.36, "T8": 0.8, "T9": 1.0, "T10": 0.7,
+                "T10_3": 0.25, "T11": 0.55, "T12": 1.0, "T14": 0.45, "T15": 0.36}
+
+# extent of the grid (lon, lat)
+_EXTENT = (-10.5, 51.4, -6.0, 55.4)
+
+def table_groups(indicators=INDICATORS):
+    """
+    [(total column or None, component columns)] of the SAPS tables used by the indicators.
+    A total is a single-column denominator; the components are the numerator columns over it.
+    Columns only found in multi-column denominators (e.g. the number of cars) form groups without a total.
+    """
+    totals = [next(iter(ind.denominator)) for ind in indicators if len(ind.denominator) == 1]
+    totals = list(dict.fromkeys(totals))
+    assigned = set(totals)
+    groups = {total: [] for total in totals}
+    for ind in indicators:
+        if len(ind.denominator) == 1:
+            for col in ind.numerator:
+                if col not in assigned:
+                    groups[next(iter(ind.denominator))].append(col)
+                    assigned.add(col)
+    out = list(groups.items())
+    for ind in indicators:
+        for cols in (ind.numerator, ind.denominator):
+            rest = [col for col in cols if col not in assigned]
+            if rest:
+                out.append((None, rest))
+                assigned.update(rest)
+    return out
+
+def _share(column):
+    table = column.split("_")
+    return _TABLE_SHARE.get("_".join(table[:2]), _TABLE_SHARE.get(table[0], 1.0))
+
+class Layout:
+    """
+    Grid cells of the synthetic small areas: IDs, counties, types and grid positions (row-major, first n cells)
+    """
+
+    def __init__(self, n_areas, seed=0, n_types=8):
+        rng = np.random.default_rng(seed)
+        self.n = n_areas
+        self.nx = int(np.ceil(np.sqrt(n_areas)))
+        self.ny = int(np.ceil(n_areas / self.nx))
+        cell = np.arange(n_areas)
+        self.row, self.col = cell // self.nx, cell % self.nx
+        # counties in contiguous blocks of a 6 x 6 block grid (Dublin's four councils side by side)
+        block = (self.row * 6 // self.ny) * 6 + self.col * 6 // self.nx
+        self.county_code = block % len(COUNTIES) + 1
+        self.county = np.array(COUNTIES, dtype=object)[self.county_code - 1]
+        order = np.lexsort((cell, self.county_code))
+        seq = np.empty(n_areas, dtype=np.int64)
+        seq[order] = np.arange(n_areas) - np.searchsorted(self.county_code[order], self.county_code[order])
+        ids = pd.Series(self.county_code).map("{:03d}".format) + pd.Series(seq + 1).map("{:06d}".format)
+        # a few merged small areas, as in the CSO files ("017001001/017001002")
+        merged = rng.random(n_areas) < 0.003
+        ids[merged] = ids[merged] + "/" + pd.Series(self.county_code[merged]).map("{:03d}".format).to_numpy() \
+            + pd.Series(seq[merged] + 2).map("{:06d}".format).to_numpy()
+        self.small_area = ids.to_numpy(dtype=object)
+        # small area types are constant over blocks of 8 x 8 cells, with 20% of areas of a random type
+        coarse = (self.row // 8) * ((self.nx + 7) // 8) + self.col // 8
+        self.type = rng.integers(0, n_types, coarse.max() + 1)[coarse]
+        noise = rng.random(n_areas) < 0.2
+        self.type[noise] = rng.integers(0, n_types, noise.sum())
+        self.n_types = n_types
+        self.population = np.maximum(np.round(rng.lognormal(np.log(300), 0.35, n_areas)), 50).astype(np.int64)
+        self.seed = seed
+
+def saps_counts(layout, indicators=INDICATORS, concentration=50.0):
+    """
+    Data frame of the raw SAPS counts (int32) of the columns used by the indicators
+    """
+    rng = np.random.default_rng(layout.seed + 1)
+    columns = {}
+    for total, components in table_groups(indicators):
+        n_cat = len(components) + (total is not None)
+        base = rng.poisson(layout.population * _share(total or components[0]))
+        # mean shares of each small area type (the "other" category, last, gets about half of the total),
+        # then the shares of each small area around them
+        alpha = np.ones(n_cat)
+        if total is not None:
+            alpha[-1] = max(1, len(components))
+        means = rng.dirichlet(alpha, layout.n_types)
+        shares = rng.gamma(concentration * means[layout.type])
+        shares /= shares.sum(axis=1, keepdims=True)
+        counts = rng.multinomial(base, shares)
+        for j, col in enumerate(components):
+            columns[col] = counts[:, j]
+        if total is not None:
+            columns[total] = base
+    return pd.DataFrame(columns).astype(np.int32)
+
+def write_saps(path, layout, width=None, chunksize=20000):
+    """
+    SAPS csv of the layout: GUID, GEOGID, GEOGDESC and the counts; with `width`, padded with filler count
+    columns up to `width` count columns (the SAPS 2016 small area file has about 800)
+    """
+    counts = saps_counts(layout)
+    rng = np.random.default_rng(layout.seed + 2)
+    n_fill = max(0, (width or 0) - counts.shape[1])
+    fillers = ["T%d_X%d" % (i % 15 + 1, i) for i in range(n_fill)]
+    ids = pd.DataFrame({"GUID": ["%032x" % i for i in range(layout.n)],
+                        "GEOGID": "SA2017_" + pd.Series(layout.small_area),
+                        "GEOGDESC": "Small Area"})
+    for start in range(0, layout.n, chunksize):
+        stop = min(start + chunksize, layout.n)
+        chunk = pd.concat([ids.iloc[start:stop], counts.iloc[start:stop]], axis=1)
+        if n_fill:
+            filler = rng.poisson(20, (stop - start, n_fill)).astype(np.int32)
+            chunk = pd.concat([chunk, pd.DataFrame(filler, columns=fillers, index=chunk.index)], axis=1)
+        chunk.to_csv(path, index=False, header=start == 0, mode="w" if start == 0 else "a")
+
+def write_refkey(path, layout):
+    pd.DataFrame({"COUNTY": layout.county_code, "COUNTYNAME": layout.county, "SMALL_AREA": layout.small_area,
+                  "GEOGID": "A" + pd.Series(layout.small_area)}).to_csv(path, index=False)
+
+def polygons(layout, edge_points=6, jitter=0.3):
+    """
+    (n, 4 * (edge_points + 1) + 1, 2) closed clockwise rings of the small areas.
+    Grid nodes and the points along each edge are jittered once, so neighbours share their border exactly.
+    """
+    rng = np.random.default_rng(layout.seed + 3)
+    nx, ny = layout.nx, layout.ny
+    dx, dy = (_EXTENT[2] - _EXTENT[0]) / nx, (_EXTENT[3] - _EXTENT[1]) / ny
+    gx, gy = np.meshgrid(_EXTENT[0] + dx * np.arange(nx + 1), _EXTENT[1] + dy * np.arange(ny + 1))
+    nodes = np.stack([gx, gy], axis=-1)
+    nodes[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (ny - 1, nx - 1, 2)) * (dx, dy) if nx > 1 and ny > 1 else 0
+    t = (np.arange(1, edge_points + 1) / (edge_points + 1))[:, None]
+    # horizontal edges (ny + 1, nx, m, 2) and vertical edges (ny, nx + 1, m, 2), jittered across the edge
+    h = nodes[:, :-1, None] + t * (nodes[:, 1:, None] - nodes[:, :-1, None])
+    h[1:-1, :, :, 1] += rng.uniform(-jitter, jitter, (ny - 1, nx, edge_points)) * dy / 2
+    v = nodes[:-1, :, None] + t * (nodes[1:, :, None] - nodes[:-1, :, None])
+    v[:, 1:-1, :, 0] += rng.uniform(-jitter, jitter, (ny, nx - 1, edge_points)) * dx / 2
+    rings = np.concatenate([nodes[:-1, :-1, None], v[:, :-1], nodes[1:, :-1, None], h[1:],
+                            nodes[1:, 1:, None], v[:, 1:, ::-1], nodes[:-1, 1:, None], h[:-1, :, ::-1],
+                            nodes[:-1, :-1, None]], axis=2)
+    return rings.reshape(nx * ny, -1, 2)[:layout.n]
+
+def _shp_header(file_length, bbox):
+    header = np.zeros(100, dtype=np.uint8)
+    header[0:4] = np.frombuffer(np.array(9994, ">i4").tobytes(), np.uint8)
+    header[24:28] = np.frombuffer(np.array(file_length // 2, ">i4").tobytes(), np.uint8)
+    header[28:36] = np.frombuffer(np.array([1000, 5], "<i4").tobytes(), np.uint8)
+    header[36:68] = np.frombuffer(np.asarray(bbox, "<f8").tobytes(), np.uint8)
+    return header.tobytes()
+
+def _dbf(n, fields):
+    # dBASE III table of n records with fixed-width fields: [(name, type, width, values)]
+    header_len = 32 + 32 * len(fields) + 1
+    record_len = 1 + sum(width for _, _, width, _ in fields)
+    today = time.localtime()
+    header = bytearray(32)
+    header[0] = 0x03
+    header[1:4] = bytes([today.tm_year - 1900, today.tm_mon, today.tm_mday])
+    header[4:12] = np.array([n], "<u4").tobytes() + np.array([header_len, record_len], "<u2").tobytes()
+    for name, ftype, width, _ in fields:
+        desc = bytearray(32)
+        desc[0:len(name)] = name.encode("ascii")
+        desc[11] = ord(ftype)
+        desc[16] = width
+        header += desc
+    header += b"\x0D"
+    dtype = np.dtype([("deleted", "S1")] + [(name, "S%d" % width) for name, _, width, _ in fields])
+    table = np.zeros(n, dtype=dtype)
+    table["deleted"] = b" "
+    for name, ftype, width, values in fields:
+        raw = np.char.encode(np.asarray(values, dtype=str), "utf-8")
+        table[name] = np.char.rjust(raw, width) if ftype == "N" else np.char.ljust(raw, width)
+    return bytes(header) + table.tobytes() + b"\x1A"
+
+def write_shapefile(path, layout, edge_points=6):
+    """
+    Polygon shape file `path` (without extension) of the small areas, one single-ring polygon per small area
+    """
+    rings = polygons(layout, edge_points)
+    n, length = rings.shape[:2]
+    lo, hi = rings.min(axis=1), rings.max(axis=1)
+    record = np.dtype([("number", ">i4"), ("content_length", ">i4"), ("type", "<i4"), ("bbox", "<f8", 4),
+                       ("n_parts", "<i4"), ("n_points", "<i4"), ("part", "<i4"), ("points", "<f8", (length, 2))])
+    shp = np.zeros(n, dtype=record)
+    shp["number"] = np.arange(1, n + 1)
+    shp["content_length"] = (record.itemsize - 8) // 2
+    shp["type"] = 5
+    shp["bbox"] = np.hstack([lo, hi])
+    shp["n_parts"], shp["n_points"] = 1, length
+    shp["points"] = rings
+    bbox = np.concatenate([lo.min(axis=0), hi.max(axis=0)])
+
+    shx = np.zeros((n, 2), dtype=">i4")
+    shx[:, 0] = (100 + np.arange(n) * record.itemsize) // 2
+    shx[:, 1] = (record.itemsize - 8) // 2
+    with open(path + ".shp", "wb") as f:
+        f.write(_shp_header(100 + shp.nbytes, bbox))
+        f.write(shp.tobytes())
+    with open(path + ".shx", "wb") as f:
+        f.write(_shp_header(100 + shx.nbytes, bbox))
+        f.write(shx.tobytes())
+    with open(path + ".dbf", "wb") as f:
+        f.write(_dbf(n, [("COUNTY", "N", 3, layout.county_code), ("COUNTYNAME", "C", 40, layout.county),
+                           ("SMALL_AREA", "C", 20, layout.small_area),
+                           ("GEOGID", "C", 21, "A" + pd.Series(layout.small_area)),
+                           ("TOTAL2016", "N", 10, layout.population)]))
+    with open(path + ".cpg", "w") as f:
+        f.write("UTF-8")
+
+def make_dataset(directory, n_areas, seed=0, edge_points=6, width=None):
+    """
+    Write the three synthetic data sets of n_areas small areas to `directory`; returns their paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {"saps": os.path.join(directory, "SAPS2016_SA2017.csv"),
+             "refkey": os.path.join(directory, "Small_Areas_Boundaries_2015.csv"),
+             "shapefile": os.path.join(directory, "Census2016_Small_Areas_generalised20m")}
+    layout = Layout(n_areas, seed)
+    write_saps(paths["saps"], layout, width)
+    write_refkey(paths["refkey"], layout)
+    write_shapefile(paths["shapefile"], layout, edge_points)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic SAPS, boundary key and shape files")
+    parser.add_argument("directory")
+    parser.add_argument("--n-areas", type=int, default=18641, help="number of small areas (18641 in the 2016 census)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--edge-points", type=int, default=6, help="vertices along each side of a small area")
+    parser.add_argument("--width", type=int, default=None, help="pad the SAPS csv with filler columns to this many counts")
+    args = parser.parse_args(argv)
+    paths = make_dataset(args.directory, args.n_areas, args.seed, args.edge_points, args.width)
+    for name, path in paths.items():
+        print("%-10s %s" % (name, path))
+
+if __name__ == "__main__":
+    main()
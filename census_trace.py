@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-level instrumentation of the pipeline.
+
+The named stages (csv read, each indicator theme, joins, each k-medoids fit, shape file reads, map renders,
+cached pipeline stages) record their wall time, CPU time, the peak resident set size of the process at their end
+and their input sizes. The records can be written as a Chrome trace (open it in chrome://tracing, Perfetto or
+speedscope for a flame graph), or summarised as a data frame.
+
+Tracing is off by default; then stage() returns one shared do-nothing context manager, so an instrumented stage
+costs a function call and a None check. Switch it on with enable(), or by setting the environment variable
+CENSUS_TRACE to the path of a trace file, which is then written when the program exits:
+
+    CENSUS_TRACE=trace.json python census_batch.py ...
+"""
+
+import atexit
+import json
+import os
+import platform
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import pandas as pd
+
+# recorded events (Chrome trace "complete" events) while tracing is on, None while it is off
+_events = None
+
+def max_rss_mb():
+    """
+    Peak resident set size of the process so far, in MB (None where it cannot be measured)
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if platform.system() == "Darwin" else rss / 2 ** 10
+
+class _Stage:
+    __slots__ = ("name", "args", "start", "cpu")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def set(self, **sizes):
+        """
+        Record sizes known only inside the stage (e.g. the number of rows read)
+        """
+        self.args.update(sizes)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.cpu = time.process_time_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end, cpu = time.perf_counter_ns(), time.process_time_ns()
+        if _events is not None:
+            args = dict(self.args, cpu_ms=(cpu - self.cpu) / 1e6, max_rss_mb=max_rss_mb())
+            _events.append({"name": self.name, "cat": "census", "ph": "X", "ts": self.start / 1e3,
+                            "dur": (end - self.start) / 1e3, "pid": os.getpid(), "tid": threading.get_ident(),
+                            "args": args})
+        return False
+
+class _NoStage:
+    __slots__ = ()
+
+    def set(self, **sizes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_OFF = _NoStage()
+
+def stage(name, **sizes):
+    """
+    Context manager timing the stage `name`; keyword arguments are recorded as its input sizes
+    """
+    if _events is None:
+        return _OFF
+    return _Stage(name, sizes)
+
+def enabled():
+    return _events is not None
+
+def enable():
+    global _events
+    if _events is None:
+        _events = []
+
+def disable():
+    global _events
+    _events = None
+
+def events():
+    return list(_events or [])
+
+def add_events(new_events):
+    """
+    Add events recorded elsewhere (e.g. returned by collect() in a worker process)
+    """
+    if _events is not None:
+        _events.extend(new_events)
+
+def collect(fn, *args, **kwargs):
+    """
+    Call fn with tracing on, e.g. in a worker process; returns its value and the events recorded meanwhile
+    """
+    global _events
+    previous, _events = _events, []
+    try:
+        value = fn(*args, **kwargs)
+        return value, _events
+    finally:
+        _events = previous
+
+def summary():
+    """
+    Data frame of the number of calls, total wall and CPU seconds and peak RSS of every stage name
+    """
+    table = pd.DataFrame([{"stage": e["name"], "seconds": e["dur"] / 1e6, "cpu_seconds": e["args"]["cpu_ms"] / 1e3,
+                           "max_rss_mb": e["args"]["max_rss_mb"]} for e in events()],
+                         columns=["stage", "seconds", "cpu_seconds", "max_rss_mb"])
+    return table.groupby("stage", sort=False).agg(calls=("seconds", "size"), seconds=("seconds", "sum"),
+                                                  cpu_seconds=("cpu_seconds", "sum"), max_rss_mb=("max_rss_mb", "max"))
+
+def write_chrome_trace(path):
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events(), "displayTimeUnit": "ms"}, f)
+
+if os.environ.get("CENSUS_TRACE"):
+    enable()
+    _trace_pid = os.getpid()
+    # only the process that switched tracing on writes the file (not forked workers)
+    atexit.register(lambda: os.getpid() == _trace_pid and write_chrome_trace(os.environ["CENSUS_TRACE"]))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Local lookup service for the small area summary variables and census clusters.
+
+The census table (the 69 summary variables, SAID and cluster1) is loaded once into memory-resident arrays,
+with the small area key registry (census_keys.py) for lookups by SAID and the spatial index (census_spatial.py)
+for lookups by (lon, lat). A small HTTP server written on asyncio (standard library only, runs offline) answers:
+
+    GET  /said/<SAID>                    one small area by ID
+    GET  /point?lon=-6.26&lat=53.35      the small area containing a point
+    POST /batch                          {"said": [...]} and/or {"points": [[lon, lat], ...]}
+    GET  /metrics                        request counts, throughput and in-process latency
+
+Run it with e.g.
+    python lookup_service.py NewCensusData_final_Dublin_clusters.csv --shapefile Census2016_Small_Areas_generalised20m --port 8080
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from census_indicators import INDICATOR_NAMES
+from census_keys import SAKeys
+from census_spatial import SpatialIndex
+
+class LookupTable:
+    """
+    In-memory table of the summary variables and cluster of every small area.
+
+    census   : data frame with a SAID column, the summary variables and (optionally) cluster1
+    geometry : optional census_geometry.Geometry of the small areas, for lookups by coordinates
+    """
+
+    def __init__(self, census, geometry=None, variables=None):
+        if variables is None:
+            variables = [c for c in INDICATOR_NAMES if c in census.columns]
+        self.variables = list(variables)
+        self.values = census[self.variables].to_numpy(dtype=np.float64)
+        self.said = census["SAID"].astype(str).to_numpy()
+        self.cluster = census["cluster1"].to_numpy() if "cluster1" in census.columns else np.full(len(census), np.nan)
+        self.keys = SAKeys(self.said)
+        self.keys.add_table("census", self.said)
+        self.index = None
+        if geometry is not None:
+            self.index = SpatialIndex(geometry)
+            # census row of every shape, so a point maps to a census row in one gather
+            self.shape_row = self.keys.rows("census", geometry.records["SMALL_AREA"])
+
+    def rows_by_said(self, saids):
+        return self.keys.rows("census", saids)
+
+    def rows_by_point(self, lon, lat):
+        if self.index is None:
+            raise ValueError("no boundaries loaded, lookups by coordinates are not available")
+        shape = self.index.locate(lon, lat)
+        return np.where(shape >= 0, self.shape_row[np.maximum(shape, 0)], -1)
+
+    def records(self, rows):
+        """
+        JSON-ready dicts of the given rows (-1 gives {"found": false})
+        """
+        out = []
+        for row in np.asarray(rows):
+            if row < 0:
+                out.append({"found": False})
+                continue
+            # NaN and the inf ratios of zero denominators have no JSON number
+            values = [v if math.isfinite(v) else None for v in self.values[row].tolist()]
+            cluster = self.cluster[row]
+            out.append({"found": True, "SAID": self.said[row],
+                        "cluster1": None if pd.isna(cluster) else int(cluster),
+                        "indicators": dict(zip(self.variables, values))})
+        return out
+
+class Metrics:
+    """
+    Request counts, items looked up, and in-process latency of the recent requests
+    """
+
+    def __init__(self, window=10000):
+        self.started = time.perf_counter()
+        self.requests = {}
+        self.items = 0
+        self.busy = 0.0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, endpoint, items, seconds):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        self.items += items
+        self.busy += seconds
+        self.latencies.append(seconds)
+
+    def report(self):
+        uptime = time.perf_counter() - self.started
+        lat = np.array(self.latencies) * 1e3
+        return {"uptime_s": uptime, "requests": self.requests, "items": self.items,
+                "items_per_s": self.items / uptime if uptime else 0.0,
+                "items_per_busy_s": self.items / self.busy if self.busy else 0.0,
+                "latency_ms": {"mean": float(lat.mean()) if len(lat) else None,
+                               "p50": float(np.percentile(lat, 50)) if len(lat) else None,
+                               "p99": float(np.percentile(lat, 99)) if len(lat) else None}}
+
+class LookupService:
+    def __init__(self, table):
+        self.table = table
+        self.metrics = Metrics()
+
+    def handle(self, method, target, body):
+        """
+        (status, JSON-ready response) of one request
+        """
+        url = urlsplit(target)
+        path = url.path.rstrip("/")
+        start = time.perf_counter()
+        if method == "GET" and path.startswith("/said/"):
+            endpoint, result = "said", self.table.records(self.table.rows_by_said([unquote(path[6:])]))[0]
+            items = 1
+        elif method == "GET" and path == "/point":
+            query = parse_qs(url.query)
+            lon, lat = float(query["lon"][0]), float(query["lat"][0])
+            endpoint, result = "point", self.table.records(self.table.rows_by_point([lon], [lat]))[0]
+            items = 1
+        elif method == "POST" and path == "/batch":
+            request = json.loads(body or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("the batch request must be a JSON object")
+            for name in ["said", "points"]:
+                if not isinstance(request.get(name, []), list):
+                    raise ValueError("\"%s\" must be a list" % name)
+            result = {}
+            if "said" in request:
+                result["said"] = self.table.records(self.table.rows_by_said(request["said"]))
+            if "points" in request:
+                points = np.asarray(request["points"], dtype=np.float64)
+                if points.size == 0:
+                    points = points.reshape(0, 2)
+                if points.ndim != 2 or points.shape[1] != 2:
+                    raise ValueError("\"points\" must be a list of [lon, lat] pairs")
+                result["points"] = self.table.records(self.table.rows_by_point(points[:, 0], points[:, 1]))
+            endpoint, items = "batch", sum(len(v) for v in result.values())
+        elif method == "GET" and path == "/metrics":
+            return 200, self.metrics.report()
+        else:
+            return 404, {"error": "unknown request %s %s" % (method, url.path)}
+        self.metrics.record(endpoint, items, time.perf_counter() - start)
+        return 200, result
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, result = self.handle(method, target, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {"error": str(e)}
+                payload = json.dumps(result).encode("utf-8")
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n"
+                             % (status, b"OK" if status == 200 else b"Error", len(payload), b"close" if close else b"keep-alive")
+                             + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local lookup service for small area census variables and clusters")
+    parser.add_argument("census", help="csv of the summary variables with SAID and cluster1 columns")
+    parser.add_argument("--shapefile", help="small area shape file (without extension), for lookups by coordinates")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    census = pd.read_csv(args.census, dtype={"SAID": str})
+    if census.columns[0].startswith("Unnamed"):
+        census = census.drop(census.columns[0], axis=1)
+    geometry = None
+    if args.shapefile:
+        from census_geometry import read_geometry
+        geometry = read_geometry(args.shapefile)
+    service = LookupService(LookupTable(census, geometry))
+    print("serving %d small areas on http://%s:%d" % (len(census), args.host, args.port))
+    asyncio.run(service.serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
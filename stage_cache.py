@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of the artifacts of each pipeline stage.
+
+The key of a stage is a hash of its name, the content of its input files, its parameters
+(e.g. region, k, random_state, the indicator definitions) and the keys of the upstream stages it uses.
+The code of a stage is not hashed: each stage passes a version number in its parameters
+(census_pipeline.VERSIONS), which is bumped whenever what the stage computes changes.
+If an artifact with that key exists it is loaded instead of recomputed, so after an edit only the stages
+whose inputs changed, and the stages downstream of them, are recomputed.
+
+Artifacts are stored in binary formats: numpy arrays as .npy (memory-mapped on load), dicts of arrays as .npz,
+data frames as pickles, census_geometry.Geometry objects as their .npy arrays, anything else as a pickle.
+File hashes are remembered together with the file size and modification time, so unchanged files are not re-read.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from census_geometry import Geometry
+from census_trace import stage
+
+Artifact = namedtuple("Artifact", ["value", "key"])
+
+def hash_value(obj):
+    """
+    sha256 of a JSON-serializable value (other objects are hashed by their repr)
+    """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+class StageCache:
+    def __init__(self, directory=".census_cache/stages"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._hash_index = os.path.join(directory, "file_hashes.json")
+
+    def file_hash(self, path):
+        """
+        sha256 of the content of a file, recomputed only when its size or modification time changes
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        index = {}
+        if os.path.exists(self._hash_index):
+            try:
+                with open(self._hash_index) as f:
+                    index = json.load(f)
+            except ValueError:
+                index = {}
+        entry = index.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        index[path] = [st.st_size, st.st_mtime_ns, sha.hexdigest()]
+        self._write_json(self._hash_index, index)
+        return sha.hexdigest()
+
+    def key(self, name, files=(), params=None, upstream=()):
+        parts = {"stage": name,
+                 "files": [self.file_hash(f) for f in files],
+                 "params": params,
+                 "upstream": [u.key if isinstance(u, Artifact) else u for u in upstream]}
+        return "%s-%s" % (name, hash_value(parts)[:24])
+
+    def run(self, name, compute, files=(), params=None, upstream=()):
+        """
+        Artifact(value, key) of a stage: loaded from the cache if its key is there, otherwise compute() and stored.
+        """
+        with stage("stage " + name) as s:
+            key = self.key(name, files, params, upstream)
+            path = os.path.join(self.directory, key)
+            s.set(key=key, cached=os.path.isdir(path))
+            if os.path.isdir(path):
+                return Artifact(self._load(path), key)
+            value = compute()
+            self._store(path, value)
+        return Artifact(value, key)
+
+    def _store(self, path, value):
+        # written to a temporary folder and renamed, so a partly written artifact is never loaded
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp, "value.npy"), value)
+        elif isinstance(value, dict) and all(isinstance(v, np.ndarray) for v in value.values()):
+            np.savez(os.path.join(tmp, "value.npz"), **value)
+        elif isinstance(value, pd.DataFrame):
+            value.to_pickle(os.path.join(tmp, "value.pkl"))
+        elif isinstance(value, Geometry):
+            value.save(os.path.join(tmp, "geometry"))
+        else:
+            with open(os.path.join(tmp, "value.pickle"), "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # stored meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load(self, path):
+        files = os.listdir(path)
+        if "value.npy" in files:
+            return np.load(os.path.join(path, "value.npy"), mmap_mode="r")
+        if "value.npz" in files:
+            with np.load(os.path.join(path, "value.npz")) as f:
+                return {name: f[name] for name in f.files}
+        if "value.pkl" in files:
+            return pd.read_pickle(os.path.join(path, "value.pkl"))
+        if "geometry" in files:
+            return Geometry.load(os.path.join(path, "geometry"))
+        with open(os.path.join(path, "value.pickle"), "rb") as f:
+            return pickle.load(f)
+
+    def _write_json(self, path, obj):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
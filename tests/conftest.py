@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+The modules are plain scripts in the repository root, not an installed package: make them importable
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+k-medoids engines and cluster selection metrics
+"""
+
+import numpy as np
+import pytest
+from sklearn.metrics import silhouette_samples
+from sklearn_extra.cluster import KMedoids
+
+from census_clustering import FasterPAM, distance_matrix, silhouette_widths
+
+def _blobs(seed, n_blobs=4, size=40):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.normal(centre, 1.0, size=(size, 3)) for centre in rng.uniform(-6, 6, (n_blobs, 3))])
+
+@pytest.mark.parametrize("seed", range(4))
+def test_fasterpam_matches_pam(seed):
+    X = _blobs(seed)
+    pam = KMedoids(4, method="pam", init="build").fit(X)
+    assert FasterPAM(4, random_state=seed).fit(X).inertia_ <= pam.inertia_ * (1 + 1e-9)
+    # started from the PAM medoids, the swaps can only keep or lower the total distance
+    assert FasterPAM(4, init=pam.medoid_indices_).fit(X).inertia_ <= pam.inertia_ * (1 + 1e-9)
+
+def test_silhouette_widths_match_sklearn():
+    X = _blobs(0)
+    labels = [FasterPAM(k, random_state=0).fit(X).labels_ for k in (2, 4, 6)]
+    # a singleton cluster has silhouette 0
+    labels.append(np.where(np.arange(len(X)) == 7, 2, labels[0]))
+    expected = np.stack([silhouette_samples(X, l) for l in labels])
+    assert np.allclose(silhouette_widths(distance_matrix(X), labels), expected, atol=1e-5)
+    assert np.allclose(silhouette_widths(X, labels, metric="euclidean", block_size=50), expected)
+    assert np.allclose(silhouette_widths(X, labels[1], metric="euclidean"), expected[1])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the shape files
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapefile as shp
+
+from census_geometry import read_dbf, read_geometry, read_region
+from census_synthetic import make_dataset
+
+@pytest.fixture(scope="module")
+def shapefile(tmp_path_factory):
+    return make_dataset(str(tmp_path_factory.mktemp("data")), 60, seed=1)["shapefile"]
+
+@pytest.mark.parametrize("where, bbox", [({"COUNTYNAME": ["Fingall"]}, None), (None, (0.0, 0.0, 1.0, 1.0))])
+def test_read_region_without_match(shapefile, where, bbox):
+    geometry = read_region(shapefile, where=where, bbox=bbox)
+    assert len(geometry) == 0
+    assert geometry.vertices.shape == (0, 2)
+    assert list(geometry.records.columns) == ["COUNTY", "COUNTYNAME", "SMALL_AREA", "GEOGID", "TOTAL2016"]
+    assert geometry.records["TOTAL2016"].dtype == np.int64
+    assert geometry.records["COUNTYNAME"].dtype == object
+
+def test_read_geometry_matches_pyshp(tmp_path):
+    path = str(tmp_path / "areas")
+    rng = np.random.default_rng(0)
+    with shp.Writer(path, shapeType=shp.POLYGON) as w:
+        w.field("SMALL_AREA", "C", 12)
+        w.field("COUNTYNAME", "C", 40)
+        w.field("TOTAL2016", "N", 8)
+        for i in range(30):
+            if i == 7:
+                w.null()
+            else:
+                # an outer ring, and for some shapes a hole or a second ring
+                x, y = rng.uniform(0, 100, 2)
+                rings = [[[x, y], [x, y + 2], [x + 2, y + 2], [x + 2, y], [x, y]]]
+                if i % 3 == 1:
+                    rings.append([[x + 0.5, y + 0.5], [x + 1.5, y + 0.5], [x + 1.5, y + 1.5], [x + 0.5, y + 0.5]])
+                if i % 5 == 2:
+                    rings.append([[x + 3, y], [x + 3, y + 1], [x + 4, y], [x + 3, y]])
+                w.poly(rings)
+            w.record("A%03d" % i, ["Fingal", "Dún Laoghaire-Rathdown"][i % 2], int(rng.integers(100, 500)))
+
+    geometry = read_geometry(path, cache_dir=str(tmp_path / "cache"))
+    reloaded = read_geometry(path, cache_dir=str(tmp_path / "cache"))
+    reader = shp.Reader(path)
+    assert len(geometry) == len(reader)
+    for i, shape in enumerate(reader.shapes()):
+        for g in (geometry, reloaded):
+            assert np.array_equal(g.coords(i), np.array(shape.points).reshape(-1, 2))
+            assert [len(p) for p in g.parts(i)] == np.diff(list(shape.parts) + [len(shape.points)]).tolist()
+            if shape.points:
+                assert np.array_equal(g.bbox[i], shape.bbox)
+            else:
+                assert np.isnan(g.bbox[i]).all()
+    expected = pd.DataFrame([list(r) for r in reader.records()], columns=[f[0] for f in reader.fields[1:]])
+    pd.testing.assert_frame_equal(geometry.records, expected)
+    pd.testing.assert_frame_equal(reloaded.records, expected)
+
+    region = read_region(path, where={"COUNTYNAME": ["Dún Laoghaire-Rathdown"]})
+    assert region.records["SMALL_AREA"].tolist() == expected["SMALL_AREA"][1::2].tolist()
+    assert np.array_equal(region.vertices, geometry.subset(np.arange(1, 30, 2)).vertices)
+
+def test_read_dbf_field_types(tmp_path):
+    path = str(tmp_path / "fields")
+    rows = [["a", 3, 1.5, datetime.date(2016, 4, 24), True], ["b", None, None, None, None],
+            ["c", 5, 2.0, None, False]]
+    with shp.Writer(path, shapeType=shp.POLYGON) as w:
+        for name, ftype, size, decimals in [("NAME", "C", 10, 0), ("POP", "N", 8, 0), ("AREA", "F", 12, 3),
+                                            ("DAY", "D", 8, 0), ("OK", "L", 1, 0)]:
+            w.field(name, ftype, size, decimals)
+        for row in rows:
+            w.poly([[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]])
+            w.record(*row)
+    table = read_dbf(path)
+    expected = [list(r) for r in shp.Reader(path).records()]
+    assert table["NAME"].tolist() == [r[0] for r in expected]
+    assert table["DAY"].dtype == "datetime64[ns]"
+    assert [None if pd.isna(d) else d.date() for d in table["DAY"]] == [r[3] for r in expected]
+    assert table["OK"].tolist() == [r[4] for r in expected]
+    assert read_dbf(path, rows=[])["DAY"].dtype == "datetime64[ns]"
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+The SAPS csv cache of census_indicators.load_saps
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import census_indicators
+from census_indicators import load_saps, required_columns
+from census_synthetic import make_dataset
+
+@pytest.fixture
+def saps(tmp_path):
+    return make_dataset(str(tmp_path / "data"), 100, seed=2)["saps"]
+
+def test_cache_keeps_the_columns_of_every_caller(saps, monkeypatch):
+    columns = required_columns()
+    first, second = columns[:4], columns[10:3:-1]
+    expected = pd.read_csv(saps, dtype={"GEOGID": str})
+    load_saps(saps, first)
+    load_saps(saps, second)
+
+    def no_parse(*args, **kwargs):
+        raise AssertionError("the csv was parsed again")
+    monkeypatch.setattr(census_indicators.pd, "read_csv", no_parse)
+    for cols in [first, second, second + first]:
+        df = load_saps(saps, cols)
+        assert list(df.columns) == ["GEOGID"] + cols
+        assert np.array_equal(df[cols].to_numpy(), expected[cols].to_numpy())
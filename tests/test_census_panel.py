@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Regression test of census_panel.release_indicators against a warm load_saps cache
+"""
+
+import numpy as np
+import pandas as pd
+
+from census_indicators import compute_indicators, load_saps
+from census_panel import CensusPanel, CensusRelease
+from census_synthetic import make_dataset
+from stage_cache import StageCache
+
+def test_column_map_with_warm_cache(tmp_path):
+    saps = make_dataset(str(tmp_path / "data"), 200, seed=1)["saps"]
+    # warm the csv cache with the default column layout
+    load_saps(saps)
+    swap = {"T1_1AGE0T": "T1_1AGETT", "T1_1AGETT": "T1_1AGE0T"}
+    panel = CensusPanel([CensusRelease(2016, saps), CensusRelease(2011, saps, columns=swap)],
+                        cache=StageCache(str(tmp_path / "stages")))
+
+    raw = pd.read_csv(saps, dtype={"GEOGID": str})
+    expected = compute_indicators(raw)
+    swapped = compute_indicators(raw.rename(columns={"T1_1AGE0T": "T1_1AGETT", "T1_1AGETT": "T1_1AGE0T"}))
+    assert np.allclose(panel[2016].to_numpy(), expected.to_numpy(), equal_nan=True)
+    assert np.allclose(panel[2011].to_numpy(), swapped.to_numpy(), equal_nan=True)
+    assert not np.allclose(panel[2011]["Age0_4"], panel[2016]["Age0_4"])
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Reloading cached pipeline stages
+"""
+
+import numpy as np
+
+import census_pipeline as pipeline
+from census_clustering import distance_matrix
+from stage_cache import StageCache
+
+def test_sweep_reloads_without_random_state(tmp_path):
+    X = np.random.default_rng(0).normal(size=(40, 3))
+    cache = StageCache(str(tmp_path))
+    data = cache.run("distances", lambda: distance_matrix(X), params={"test": 1})
+    first = pipeline.sweep(cache, data, range(1, 4), random_state=None, n_jobs=1)
+    again = pipeline.sweep(cache, data, range(1, 4), random_state=None, n_jobs=1)
+    assert again.key == first.key
+    assert int(again.value["random_state"]) == -1
+    assert np.array_equal(again.value["labels"], first.value["labels"])
+    final = pipeline.final(cache, data, again, k=3, random_state=None)
+    assert np.array_equal(final.value["cluster1"], again.value["labels"][2] + 1)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Levels of detail of the boundaries
+"""
+
+import numpy as np
+import pytest
+
+from census_geometry import read_geometry
+from census_simplify import default_tolerances, simplify
+from census_spatial import contiguity
+from census_synthetic import make_dataset
+
+@pytest.fixture(scope="module")
+def geometry(tmp_path_factory):
+    return read_geometry(make_dataset(str(tmp_path_factory.mktemp("data")), 300, seed=2)["shapefile"], cache=False)
+
+def _distance(points, a, b):
+    # distance of each point to the nearest segment a[i]-b[i]
+    ab, ap = b - a, points[:, None] - a
+    t = np.clip((ap * ab).sum(axis=2) / (ab ** 2).sum(axis=1), 0.0, 1.0)
+    return np.hypot(*(ap - t[..., None] * ab).transpose(2, 0, 1)).min(axis=1)
+
+@pytest.mark.parametrize("level", [0, 2, 5])
+def test_simplify_keeps_shapes_and_neighbours(geometry, level):
+    tolerance = default_tolerances(geometry)[level]
+    simplified = simplify(geometry, tolerance)
+    assert len(simplified.vertices) < len(geometry.vertices)
+    assert (np.diff(simplified.shape_offsets) > 0).all()
+    for kind in ["queen", "rook"]:
+        assert (contiguity(simplified, kind=kind, cache=False) != contiguity(geometry, kind=kind, cache=False)).nnz == 0
+    for i in range(0, len(geometry), 37):
+        ring = simplified.coords(i)
+        assert _distance(geometry.coords(i), ring[:-1], ring[1:]).max() <= tolerance * (1 + 1e-9)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Point-in-polygon lookups and contiguity
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib.path import Path
+
+from census_geometry import Geometry, read_geometry
+from census_spatial import SpatialIndex, contiguity
+from census_synthetic import make_dataset
+
+def test_locate_matches_matplotlib(tmp_path):
+    geometry = read_geometry(make_dataset(str(tmp_path), 200, seed=3)["shapefile"], cache=False)
+    bbox = geometry.bbox
+    rng = np.random.default_rng(0)
+    # points over the whole extent and a margin around it, so some fall outside every shape
+    lo, hi = bbox[:, :2].min(axis=0), bbox[:, 2:].max(axis=0)
+    xy = rng.uniform(lo - 0.1 * (hi - lo), hi + 0.1 * (hi - lo), size=(5000, 2))
+    inside = np.stack([Path(geometry.coords(i)).contains_points(xy) for i in range(len(geometry))], axis=1)
+    expected = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+    assert (expected == -1).any()
+    index = SpatialIndex(geometry)
+    assert np.array_equal(index.locate(xy[:, 0], xy[:, 1], chunk_size=1000), expected)
+    assert np.array_equal(index.locate(xy[:, 0], xy[:, 1], chunk_size=1000, n_jobs=2), expected)
+
+def _grid(n):
+    # n x n unit squares as closed clockwise rings, row by row
+    x, y = np.meshgrid(np.arange(n), np.arange(n))
+    corners = np.array([[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]])
+    vertices = (np.stack([x.ravel(), y.ravel()], axis=1)[:, None] + corners).reshape(-1, 2).astype(np.float64)
+    bbox = np.stack([x.ravel(), y.ravel(), x.ravel() + 1, y.ravel() + 1], axis=1).astype(np.float64)
+    return Geometry(vertices, np.arange(0, 5 * n * n + 1, 5), np.arange(n * n + 1), bbox,
+                    pd.DataFrame({"SMALL_AREA": np.arange(n * n).astype(str)}))
+
+@pytest.mark.parametrize("kind, neighbours", [("queen", [3, 5, 3, 5, 8, 5, 3, 5, 3]),
+                                              ("rook", [2, 3, 2, 3, 4, 3, 2, 3, 2])])
+def test_contiguity_of_a_grid(kind, neighbours):
+    graph = contiguity(_grid(3), kind=kind, cache=False)
+    assert (graph != graph.T).nnz == 0
+    assert graph.diagonal().sum() == 0
+    assert graph.sum(axis=1).A1.tolist() == neighbours